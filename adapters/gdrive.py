@@ -2,7 +2,7 @@ import re
 import json
 from urllib.error import HTTPError
 
-import requests
+from . import session
 
 
 def _read_api_key():
@@ -17,12 +17,14 @@ GOOGLE_DRIVE_API_KEY = _read_api_key()
 FILE_ID_PATTERN = re.compile(r'^[-_a-z0-9]+$', re.IGNORECASE)
 
 
-def download(file_id, mime_type):
+def download(file_id, mime_type, **kwargs):
+    """Export a Drive file, `kwargs` (timeout, retries, backoff) are passed on to `session.get`."""
+
     if not FILE_ID_PATTERN.match(file_id):
         raise ValueError(f'Invalid file ID: Must match pattern {FILE_ID_PATTERN.pattern}')
 
     url = f'{GOOGLE_DRIVE_API_URL}/files/{file_id}/export'
-    resp = requests.get(url, {'mimeType': mime_type, 'key': GOOGLE_DRIVE_API_KEY})
+    resp = session.get(url, {'mimeType': mime_type, 'key': GOOGLE_DRIVE_API_KEY}, **kwargs)
     if resp.ok:
         return resp.content
     else:
@@ -1,10 +1,18 @@
+import io
 import json
 import os
 import re
+import threading
 
-from pymongo import MongoClient
+import zstandard
+from bson import Binary
+from gridfs import GridFSBucket
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from pymongo.server_api import ServerApi
 
+from common import file_hash
+
 
 def _read_license_path():
     with open('.secrets/config.json', 'r') as fp:
@@ -13,7 +21,17 @@ def _read_license_path():
 
 
 MONGO_DB_BASE_URL = 'mongodb+srv://parrot-qa-cluster-0.1ecao.mongodb.net'
-MONGO_DB_LICENSE_PATH = _read_license_path()
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_POOL_SIZE = 16
+
+# Raw files up to this size are stored compressed inside their document, larger ones in GridFS
+INLINE_LIMIT = 1 << 20
+ZSTD_LEVEL = 10
+RAW_BUCKET = 'raw'
+
+_clients = {}
+_lock = threading.Lock()
 
 DB_NAME_PATTERN = re.compile(r'^[-_a-z0-9]+$', re.IGNORECASE)
 
@@ -36,11 +54,35 @@ COURSES_SCHEMA = {
     'index': 'name'
 }
 
+BLOB_SCHEMA = {
+    'bsonType': 'object',
+    'required': ['encoding', 'size', 'sha256'],
+    'description': 'must be the zstd compressed raw file, inline (data) or in GridFS (gridfs_id)',
+    'properties': {
+        'encoding': {
+            'enum': ['zstd']
+        },
+        'size': {
+            'bsonType': ['int', 'long'],
+            'description': 'size of the uncompressed file'
+        },
+        'sha256': {
+            'bsonType': 'string'
+        },
+        'data': {
+            'bsonType': 'binData'
+        },
+        'gridfs_id': {
+            'bsonType': 'objectId'
+        }
+    }
+}
+
 MATERIALS_SCHEMA = {
     'name': 'materials',
     'schema': {
         'bsonType': 'object',
-        'required': ['course', 'uri', 'type', 'raw'],
+        'required': ['course', 'uri', 'type', 'blob'],
         'properties': {
             'course': {
                 'bsonType': 'objectId',
@@ -54,20 +96,22 @@ MATERIALS_SCHEMA = {
                 'enum': ['html', 'pdf', 'docx', 'pptx', 'xlsx', 'csv', 'tsv', 'txt'],
                 'description': 'must be one of valid document types'
             },
-            'raw': {
-                'bsonType': 'string',
-                'description': 'must be a string and is required'
+            'blob': BLOB_SCHEMA,
+            'updated_at': {
+                'bsonType': 'date',
+                'description': 'must be the time the blob last changed'
             }
         }
     },
-    'index': 'uri'
+    'index': 'uri',
+    'secondary_indexes': [[('updated_at', 1), ('_id', 1)]]
 }
 
 FORUMS_SCHEMA = {
     'name': 'forums',
     'schema': {
         'bsonType': 'object',
-        'required': ['course', 'uri', 'type', 'raw'],
+        'required': ['course', 'uri', 'type', 'blob'],
         'properties': {
             'course': {
                 'bsonType': 'objectId',
@@ -81,36 +125,333 @@ FORUMS_SCHEMA = {
                 'enum': ['piazza'],
                 'description': 'must be one of valid document types'
             },
-            'raw': {
+            'blob': BLOB_SCHEMA,
+            'updated_at': {
+                'bsonType': 'date',
+                'description': 'must be the time the blob last changed'
+            }
+        }
+    },
+    'index': 'uri',
+    'secondary_indexes': [[('updated_at', 1), ('_id', 1)]]
+}
+
+DOCUMENTS_SCHEMA = {
+    'name': 'documents',
+    'schema': {
+        'bsonType': 'object',
+        'required': ['course', 'material', 'title', 'contents'],
+        'properties': {
+            'course': {
+                'bsonType': 'objectId',
+                'description': 'must be an ObjectId and is required'
+            },
+            'material': {
+                'bsonType': 'objectId',
+                'description': 'must be an ObjectId and is required'
+            },
+            'title': {
                 'bsonType': 'string',
                 'description': 'must be a string and is required'
+            },
+            'contents': {
+                'bsonType': 'array',
+                'description': 'must be an array of tagged text and is required'
             }
         }
     },
-    'index': 'uri'
+    'index': [('material', 1), ('title', 1)]
 }
 
+QA_PAIRS_SCHEMA = {
+    'name': 'qa_pairs',
+    'schema': {
+        'bsonType': 'object',
+        'required': ['course', 'forum', 'id', 'subject', 'content', 'student_answer', 'instructor_answer'],
+        'properties': {
+            'course': {
+                'bsonType': 'objectId',
+                'description': 'must be an ObjectId and is required'
+            },
+            'forum': {
+                'bsonType': 'objectId',
+                'description': 'must be an ObjectId and is required'
+            },
+            'id': {
+                'bsonType': 'string',
+                'description': 'must be a string and is required'
+            },
+            'subject': {
+                'bsonType': 'string',
+                'description': 'must be a string and is required'
+            },
+            'content': {
+                'bsonType': 'string',
+                'description': 'must be a string and is required'
+            },
+            'student_answer': {
+                'bsonType': 'string',
+                'description': 'must be a string and is required'
+            },
+            'instructor_answer': {
+                'bsonType': 'string',
+                'description': 'must be a string and is required'
+            }
+        }
+    },
+    'index': [('course', 1), ('id', 1)]
+}
+
+ALL_SCHEMAS = [COURSES_SCHEMA, MATERIALS_SCHEMA, FORUMS_SCHEMA, DOCUMENTS_SCHEMA, QA_PAIRS_SCHEMA]
+
 
-def connect(db_name='test'):
+def get_client(uri=None, pool_size=DEFAULT_POOL_SIZE):
+    """Shared client per URI, so that its connection pool is reused across calls (and threads).
+
+    Without a URI, the cluster is used with the X.509 license from the secrets, e.g. mongodb://localhost:27017
+    connects to a local mongod instead.
+    """
+
+    key = uri or MONGO_DB_BASE_URL
+    with _lock:
+        if key not in _clients:
+            if uri is None:
+                # Read lazily, so that the module can be used without the cluster license
+                _clients[key] = MongoClient(
+                    f'{MONGO_DB_BASE_URL}/?authSource=%24external&authMechanism=MONGODB-X509&retryWrites=true&w=majority',
+                    tls=True, tlsCertificateKeyFile=_read_license_path(), server_api=ServerApi('1'),
+                    maxPoolSize=pool_size)
+            else:
+                _clients[key] = MongoClient(uri, maxPoolSize=pool_size)
+        return _clients[key]
+
+
+def connect(db_name='test', uri=None):
     if not DB_NAME_PATTERN.match(db_name):
         raise ValueError('Database name is invalid.')
 
-    uri = f'{MONGO_DB_BASE_URL}/{db_name}?authSource=%24external&authMechanism=MONGODB-X509&retryWrites=true&w=majority'
-    m = MongoClient(uri, tls=True, tlsCertificateKeyFile=MONGO_DB_LICENSE_PATH, server_api=ServerApi('1'))
-    return m.get_database()
+    return get_client(uri)[db_name]
+
 
+def create_collection(db, schema, validate=True):
+    """Create a collection with its indexes, and its schema validator unless `validate` is False (e.g. for
+    stand-ins such as mongomock, which do not support validators)."""
 
-def create_collection(db, schema):
-    coll = db.create_collection(
-        schema['name'],
-        validator={'$jsonSchema': schema['schema']}
-    )
+    options = {'validator': {'$jsonSchema': schema['schema']}} if validate else {}
+    coll = db.create_collection(schema['name'], **options)
     coll.create_index(schema['index'], unique=True)
+    for index in schema.get('secondary_indexes', []):
+        coll.create_index(index)
     return coll
 
 
+def ensure_collections(db, schemas=None, validate=True):
+    """Create the collections that do not exist yet, returns {name: collection} of all of them.
+
+    Existing collections get the current schema validator (unless `validate` is False), and any missing index.
+    """
+
+    existing = set(db.list_collection_names())
+    collections = {}
+    for schema in schemas or ALL_SCHEMAS:
+        if schema['name'] in existing:
+            collections[schema['name']] = db[schema['name']]
+            if validate:
+                # Collections created by an earlier version keep their validator, e.g. one requiring `raw`
+                db.command('collMod', schema['name'], validator={'$jsonSchema': schema['schema']})
+            # Indexes added since the collection was created, creating an existing index does nothing
+            for index in schema.get('secondary_indexes', []):
+                db[schema['name']].create_index(index)
+        else:
+            collections[schema['name']] = create_collection(db, schema, validate)
+    return collections
+
+
+def put_raw(db, path, previous=None):
+    """Store a raw file compressed with zstd, returns the `blob` to save in its document.
+
+    Files up to INLINE_LIMIT bytes are stored in the blob itself, larger ones are streamed to GridFS. If the
+    `previous` blob of the document has the same content, it is returned as is and nothing is stored.
+    """
+
+    size = os.path.getsize(path)
+    sha256 = file_hash(path)
+    if previous is not None and previous.get('sha256') == sha256:
+        return previous
+
+    blob = {'encoding': 'zstd', 'size': size, 'sha256': sha256}
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    with open(path, 'rb') as fp:
+        if size <= INLINE_LIMIT:
+            blob['data'] = Binary(compressor.compress(fp.read()))
+        else:
+            bucket = GridFSBucket(db, bucket_name=RAW_BUCKET)
+            blob['gridfs_id'] = bucket.upload_from_stream(
+                os.path.basename(path), compressor.stream_reader(fp), metadata={'sha256': sha256, 'size': size})
+    return blob
+
+
+def open_raw(db, doc):
+    """Stream the original bytes of a material or forum, whichever way they are stored."""
+
+    blob = doc.get('blob')
+    if blob is None:
+        # Documents loaded before raw files were stored as blobs
+        return io.BytesIO(doc['raw'].encode('utf-8'))
+    if 'gridfs_id' in blob:
+        source = GridFSBucket(db, bucket_name=RAW_BUCKET).open_download_stream(blob['gridfs_id'])
+    else:
+        source = io.BytesIO(blob['data'])
+    return zstandard.ZstdDecompressor().stream_reader(source, closefd=True)
+
+
+def delete_raw(db, blob):
+    """Delete the GridFS file of a blob no longer referenced by its document, inline blobs need nothing."""
+
+    if blob is not None and 'gridfs_id' in blob:
+        GridFSBucket(db, bucket_name=RAW_BUCKET).delete(blob['gridfs_id'])
+
+
+def watch(db, collections, resume_after=None):
+    """Change stream of the inserts, updates, replacements and deletions in the given collections.
+
+    Events carry the full current document. Change streams require a replica set (or sharded cluster), other
+    deployments raise OperationFailure.
+    """
+
+    pipeline = [{'$match': {
+        'ns.coll': {'$in': list(collections)},
+        'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}
+    }}]
+    return db.watch(pipeline, full_document='updateLookup', resume_after=resume_after)
+
+
+def poll_updates(coll, since=None):
+    """Documents updated after the `since` position, a (updated_at, _id) pair, in order of that position.
+
+    A fallback to change streams, using the (updated_at, _id) index. Deletions are not seen.
+    """
+
+    query = {'updated_at': {'$exists': True}}
+    if since is not None:
+        updated_at, last_id = since
+        query = {'$or': [{'updated_at': {'$gt': updated_at}}, {'updated_at': updated_at, '_id': {'$gt': last_id}}]}
+    return coll.find(query).sort([('updated_at', 1), ('_id', 1)])
+
+
+class BulkUpserter:
+    """Buffer upserts to a collection, and write them in unordered `bulk_write` batches.
+
+    Every document is matched on its `keys` fields (those of the collection's unique index), and `$set` as a whole,
+    with `insert_only` fields only set when the document is created and `unset` fields removed. Use as a context
+    manager to flush the last batch. Errors of single documents do not stop the batch, they are counted and the
+    first few kept for reporting.
+    Documents added with a `tag` have it collected in `succeeded` or `failed` once written.
+    """
+
+    MAX_ERRORS_KEPT = 10
+
+    def __init__(self, coll, keys, batch_size=DEFAULT_BATCH_SIZE):
+        self.coll = coll
+        self.keys = keys
+        self.batch_size = batch_size
+        self.ops = []
+        self.upserted = 0
+        self.modified = 0
+        self.matched = 0
+        self.errors = []
+        self.error_count = 0
+        self.tags = []
+        self.succeeded = []
+        self.failed = []
+
+    def add(self, doc, insert_only=None, unset=None, tag=None):
+        update = {'$set': doc}
+        if insert_only:
+            update['$setOnInsert'] = insert_only
+        if unset:
+            update['$unset'] = {field: '' for field in unset}
+        self.ops.append(UpdateOne({k: doc[k] for k in self.keys}, update, upsert=True))
+        self.tags.append(tag)
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.ops:
+            return
+        ops, self.ops = self.ops, []
+        tags, self.tags = self.tags, []
+        try:
+            result = self.coll.bulk_write(ops, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+            self.error_count += len(result['writeErrors'])
+            self.errors.extend(err['errmsg'] for err in result['writeErrors'][:self.MAX_ERRORS_KEPT - len(self.errors)])
+        failed = {err['index'] for err in result.get('writeErrors', [])}
+        for i, tag in enumerate(tags):
+            if tag is not None:
+                (self.failed if i in failed else self.succeeded).append(tag)
+        self.upserted += result['nUpserted']
+        self.modified += result['nModified']
+        self.matched += result['nMatched']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def summary(self):
+        return f'{self.upserted} inserted, {self.modified} updated, {self.matched - self.modified} unchanged, {self.error_count} failed'
+
+
 if __name__ == '__main__':
+    import mongomock
     from pymongo.database import Database
+
+    # Unit test: Batched upserts are idempotent, and only insert_only fields are kept on updates
+    coll = mongomock.MongoClient().db.coll
+    coll.create_index('uri', unique=True)
+    with BulkUpserter(coll, ['uri'], batch_size=2) as upserter:
+        for i in range(5):
+            upserter.add({'uri': str(i), 'raw': 'a'}, insert_only={'created': i})
+    assert (upserter.upserted, coll.count_documents({})) == (5, 5)
+    with BulkUpserter(coll, ['uri'], batch_size=2) as upserter:
+        for i in range(5):
+            upserter.add({'uri': str(i), 'raw': 'b' if i < 2 else 'a'}, insert_only={'created': -1})
+    assert (upserter.upserted, upserter.modified, upserter.matched) == (0, 2, 5)
+    assert coll.find_one({'uri': '1'}) | {'_id': None} == {'_id': None, 'uri': '1', 'raw': 'b', 'created': 1}
+    with BulkUpserter(coll, ['uri']) as upserter:
+        upserter.add({'uri': '1', 'blob': {}}, unset=['raw'])
+    assert coll.find_one({'uri': '1'}) | {'_id': None} == {'_id': None, 'uri': '1', 'blob': {}, 'created': 1}
+
+    # Unit test: Small files are stored inline, large ones in GridFS, and both read back the same
+    import tempfile
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    db = mongomock.MongoClient().db
+    for size in [100, 2 * INLINE_LIMIT]:
+        with tempfile.NamedTemporaryFile(delete=False) as fp:
+            fp.write(os.urandom(size // 2) * 2)
+        blob = put_raw(db, fp.name)
+        assert ('data' in blob) == (size <= INLINE_LIMIT)
+        with open(fp.name, 'rb') as src, open_raw(db, {'blob': blob}) as raw:
+            assert raw.read() == src.read()
+        assert put_raw(db, fp.name, previous=blob) is blob
+        delete_raw(db, blob)
+        os.remove(fp.name)
+    assert db['raw.files'].count_documents({}) == 0
+    assert open_raw(db, {'raw': 'abc'}).read() == b'abc'
+
+    # Unit test: Polling resumes after the last seen (updated_at, _id), including ties on updated_at
+    import datetime
+    coll = mongomock.MongoClient().db.coll
+    at = [datetime.datetime(2022, 1, 1, minute=m) for m in [0, 1, 1, 2]]
+    coll.insert_many([{'_id': i, 'updated_at': t} for i, t in enumerate(at)] + [{'_id': 4}])
+    assert [d['_id'] for d in poll_updates(coll)] == [0, 1, 2, 3]
+    assert [d['_id'] for d in poll_updates(coll, since=(at[1], 1))] == [2, 3]
+
+    # Unit test: Cluster connection
     db = connect('test')
     assert type(db) == Database
 
@@ -1,7 +1,15 @@
-import time
+import os
+import json
 from piazza_api import Piazza
 from piazza_api.network import FolderFilter
 
+from .throttle import AdaptiveDelay
+
+
+MAX_ATTEMPTS = 5
+
+CHECKPOINT_INTERVAL = 10
+
 
 def login():
     p = Piazza()
@@ -9,45 +17,118 @@ def login():
     return p
 
 
-def _from_all(course_net):
-    course_posts = course_net.iter_all_posts()
-    for post in course_posts:
-        time.sleep(1)
-        yield post
+class Checkpoint:
+    """Download progress of a forum, persisted to disk.
 
+    Holds the modified time of every post in the local copy, and while a download is in progress, the feed
+    being downloaded and a cursor into it.
+    """
 
-def _from_folders(course_net, folders):
-    seen = set()  # To remove duplicates, when a post is tagged to multiple folders
-    for folder in folders:
-        filter = FolderFilter(folder)
-        course_posts = course_net.get_filtered_feed(filter)
-        for post in course_posts['feed']:
-            if post['id'] in seen:
-                continue
-            else:
-                seen.add(post['id'])
-                time.sleep(1)
-                # The folder feed is just meta data, need another endpoint for complete post info
-                yield course_net.get_post(post['id'])
+    def __init__(self, path):
+        self.path = path
+        self.posts = {}
+        self.feed = None
+        self.cursor = 0
+        if os.path.isfile(path):
+            with open(path) as fp:
+                state = json.load(fp)
+            self.posts = state['posts']
+            self.feed = state['feed']
+            self.cursor = state['cursor']
 
+    @property
+    def in_progress(self):
+        return self.feed is not None
+
+    def start(self, feed):
+        self.feed = feed
+        self.cursor = 0
+        self.save()
+
+    def advance(self, cursor):
+        self.cursor = cursor
+        if cursor % CHECKPOINT_INTERVAL == 0:
+            self.save()
+
+    def finish(self, posts):
+        self.posts = posts
+        self.feed = None
+        self.cursor = 0
+        self.save()
+
+    def save(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'posts': self.posts, 'feed': self.feed, 'cursor': self.cursor}, fp)
+        os.replace(tmp, self.path)
+
+
+def _list_feed(course_net, folders):
+    """List [id, modified time] of every post, the feed is just meta data."""
 
-def download_posts(p, course_id, folders=[], limit=None):
-    course_net = p.network(course_id)
     if len(folders) > 0:
-        post_generator = _from_folders(course_net, folders)
+        feed = []
+        seen = set()  # To remove duplicates, when a post is tagged to multiple folders
+        for folder in folders:
+            for post in course_net.get_filtered_feed(FolderFilter(folder))['feed']:
+                if post['id'] not in seen:
+                    seen.add(post['id'])
+                    feed.append(post)
     else:
-        post_generator = _from_all(course_net)
-
-    raw_posts = []
-    for post in post_generator:
-        if len(raw_posts) and len(raw_posts) % 10 == 0:
-            print(f'Downloaded {len(raw_posts)} posts so far...')
-        if limit and len(raw_posts) == limit:
-            break
+        feed = course_net.get_feed(limit=999999, offset=0)['feed']
+
+    return [[post['id'], post.get('modified')] for post in feed]
+
+
+def _get_post(course_net, post_id, pacing):
+    for attempt in range(MAX_ATTEMPTS):
+        pacing.wait()
+        try:
+            post = course_net.get_post(post_id)
+        except Exception as e:
+            # Piazza rejects requests that come in too fast, slow down and retry
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            pacing.failure()
+            print(f'Retrying post {post_id} in {pacing.delay:.1f}s: {e}')
         else:
-            raw_posts.append(post)
+            pacing.success()
+            return post
+
+
+def iter_posts(p, course_id, folders=[], limit=None, known={}, checkpoint=None):
+    """Yield posts one at a time as they are downloaded.
+
+    Posts listed in `known` (id -> modified time) are skipped if they have not been modified since. If a
+    checkpoint is given, progress is saved as posts are consumed and an interrupted download is resumed.
+    """
 
-    return raw_posts
+    course_net = p.network(course_id)
+    if checkpoint is not None and checkpoint.in_progress:
+        feed, cursor = checkpoint.feed, checkpoint.cursor
+        print(f'Resuming download from post {cursor} of {len(feed)}...')
+    else:
+        feed, cursor = _list_feed(course_net, folders), 0
+        if limit:
+            feed = feed[:limit]
+        if checkpoint is not None:
+            checkpoint.start(feed)
+
+    pacing = AdaptiveDelay()
+    count = 0
+    for i in range(cursor, len(feed)):
+        post_id, modified = feed[i]
+        if modified is None or known.get(post_id) != modified:
+            yield _get_post(course_net, post_id, pacing)
+            count += 1
+            if count % 10 == 0:
+                print(f'Downloaded {count} posts so far...')
+        if checkpoint is not None:
+            checkpoint.advance(i + 1)
+
+
+def download_posts(p, course_id, folders=[], limit=None):
+    return list(iter_posts(p, course_id, folders, limit))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 0.5
+DEFAULT_POOL_SIZE = 16
+
+MAX_BACKOFF = 60
+MAX_RETRY_AFTER = 300
+
+_session = None
+_pool_size = DEFAULT_POOL_SIZE
+_lock = threading.Lock()
+
+
+def configure(pool_size=DEFAULT_POOL_SIZE):
+    """Set the connection pool size, takes effect on the next request."""
+
+    global _session, _pool_size
+    with _lock:
+        _pool_size = pool_size
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session():
+    """Shared session, so that connections are kept alive and reused across requests."""
+
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=_pool_size, pool_maxsize=_pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _retry_after(resp):
+    """Parse the Retry-After header, which is either in seconds or an HTTP date."""
+
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+
+def _backoff(attempt, backoff):
+    """Exponential backoff with full jitter."""
+
+    return random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+
+
+def get(url, params=None, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, **kwargs):
+    """GET with retries on connection errors, timeouts and 429/5xx responses.
+
+    The last response is returned as is once retries are exhausted, so callers can still inspect it.
+    """
+
+    session = get_session()
+    for attempt in range(retries + 1):
+        try:
+            resp = session.get(url, params=params, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            delay = None
+        else:
+            if resp.status_code not in RETRY_STATUS or attempt == retries:
+                return resp
+            delay = _retry_after(resp)
+
+        if delay is None:
+            delay = _backoff(attempt, backoff)
+        time.sleep(delay)
+
+
+if __name__ == '__main__':
+    # Unit test: Retry-After parsing
+    resp = requests.Response()
+    resp.headers['Retry-After'] = '3'
+    assert _retry_after(resp) == 3
+    resp.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    assert _retry_after(resp) == 0
+    resp.headers['Retry-After'] = 'garbage'
+    assert _retry_after(resp) is None
+
+    # Unit test: Backoff is bounded
+    assert all(0 <= _backoff(i, 0.5) <= MAX_BACKOFF for i in range(20))
+
+    # Unit test: Basic request
+    resp = get('https://cs61a.org/articles/about/')
+    assert resp.ok
+
+    print('All unit tests passed.')
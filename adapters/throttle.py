@@ -0,0 +1,139 @@
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+# Per-host budgets: (max concurrent requests, sustained requests/sec, burst size)
+HOST_LIMITS = {
+    'cs61a.org': (4, 4.0, 8),
+    'ds100.org': (4, 4.0, 8),
+    'www.textbook.ds100.org': (4, 4.0, 8),
+    'inst.eecs.berkeley.edu': (4, 4.0, 8),
+    'www.googleapis.com': (4, 2.0, 4),
+    'piazza.com': (1, 1.0, 1),
+}
+
+DEFAULT_HOST_LIMIT = (2, 2.0, 4)
+
+
+class TokenBucket:
+    """Thread-safe token bucket, refilled at `rate` tokens/sec up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostThrottle:
+    """Caps the number of in-flight requests and the request rate for every host."""
+
+    def __init__(self, limits=HOST_LIMITS, default=DEFAULT_HOST_LIMIT):
+        self.limits = limits
+        self.default = default
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                concurrency, rate, burst = self.limits.get(host, self.default)
+                self._hosts[host] = (threading.Semaphore(concurrency), TokenBucket(rate, burst))
+            return self._hosts[host]
+
+    @contextmanager
+    def limit(self, host):
+        slots, bucket = self._get(host)
+        with slots:
+            bucket.acquire()
+            yield
+
+
+class AdaptiveDelay:
+    """Pace sequential requests: back off multiplicatively on errors, speed up gradually on successes."""
+
+    def __init__(self, initial=1.0, minimum=0.2, maximum=60.0, speedup=0.9, backoff=2.0):
+        self.delay = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.speedup = speedup
+        self.backoff = backoff
+
+    def wait(self):
+        time.sleep(self.delay)
+
+    def success(self):
+        self.delay = max(self.minimum, self.delay * self.speedup)
+
+    def failure(self):
+        self.delay = min(self.maximum, self.delay * self.backoff)
+
+
+def host_of(uri):
+    """Host whose budget a URI is charged against."""
+
+    host = urlparse(uri).netloc.lower()
+    if host == 'docs.google.com':
+        # Google documents are fetched through the Drive export API
+        return 'www.googleapis.com'
+    return host
+
+
+if __name__ == '__main__':
+    # Unit test: Host mapping
+    assert host_of('https://cs61a.org/articles/about/') == 'cs61a.org'
+    assert host_of('https://docs.google.com/document/d/abc/edit') == 'www.googleapis.com'
+
+    # Unit test: Burst is served immediately, then requests are spaced by the rate
+    bucket = TokenBucket(rate=20.0, capacity=2)
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+    # Unit test: Concurrency cap per host
+    throttle = HostThrottle(limits={'a': (1, 1000.0, 1000)})
+    active, peak = [], []
+
+    def work():
+        with throttle.limit('a'):
+            active.append(1)
+            peak.append(len(active))
+            time.sleep(0.01)
+            active.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(peak) == 1
+
+    # Unit test: Adaptive delay stays within bounds
+    delay = AdaptiveDelay(initial=1.0, minimum=0.5, maximum=4.0)
+    for _ in range(10):
+        delay.failure()
+    assert delay.delay == 4.0
+    for _ in range(100):
+        delay.success()
+    assert delay.delay == 0.5
+
+    print('All unit tests passed.')
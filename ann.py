@@ -0,0 +1,207 @@
+import os
+
+import numpy as np
+
+
+# Number of vectors compared against all queries at once, bounds the size of the similarity matrix
+BLOCK_SIZE = 8192
+
+# K-means is trained on a sample of at most this many vectors per list, more barely moves the centroids
+TRAIN_POINTS_PER_LIST = 64
+
+
+def _merge_top_k(scores, ids, new_scores, new_ids, k):
+    """Merge two sets of (scores, ids) rows, keeping the k best of each row sorted by descending score."""
+
+    scores = np.concatenate([scores, new_scores], axis=1)
+    ids = np.concatenate([ids, new_ids], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class ExactIndex:
+    """Brute-force inner product search over (normalized) vectors, done in blocks."""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def search(self, queries, k=1):
+        """Return (scores, ids) of the k nearest vectors for every query, rows sorted by descending score.
+
+        Rows are padded with score -inf and id -1 if there are fewer than k vectors.
+        """
+
+        scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), 0), -1, dtype=np.int64)
+        for start in range(0, len(self.vectors), BLOCK_SIZE):
+            block = queries @ self.vectors[start:start + BLOCK_SIZE].T
+            block_ids = np.broadcast_to(np.arange(start, start + block.shape[1]), block.shape)
+            scores, ids = _merge_top_k(scores, ids, block, block_ids, k)
+        return _pad(scores, ids, k)
+
+
+def _assign(vectors, centroids):
+    """Index of the nearest centroid of every vector."""
+
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        block = vectors[start:start + BLOCK_SIZE]
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+class IVFIndex:
+    """Inverted file index: vectors are bucketed by their nearest of `n_lists` centroids (spherical k-means),
+    and a query only searches the `n_probe` buckets with the closest centroids.
+
+    Raising `n_probe` trades speed for recall, with n_probe == n_lists being an exact search. K-means is trained
+    on a sample of the vectors, and the trained centroids can be saved and passed back to skip training.
+    """
+
+    def __init__(self, vectors, n_lists=None, n_probe=8, iterations=10, seed=0, centroids=None):
+        self.vectors = vectors
+        self.n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+        self.n_probe = n_probe
+        self.centroids = self._train(iterations, seed) if centroids is None else centroids
+
+        assignment = _assign(vectors, self.centroids)
+        self.order = np.argsort(assignment, kind='stable')
+        self.offsets = np.searchsorted(assignment[self.order], np.arange(len(self.centroids) + 1))
+
+    def _train(self, iterations, seed):
+        rng = np.random.default_rng(seed)
+        n_train = min(len(self.vectors), TRAIN_POINTS_PER_LIST * self.n_lists)
+        sample = np.sort(rng.choice(len(self.vectors), size=n_train, replace=False))
+        sample = np.asarray(self.vectors[sample], dtype=np.float32)
+        centroids = sample[rng.choice(n_train, size=min(self.n_lists, n_train), replace=False)]
+        for _ in range(iterations):
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, _assign(sample, centroids), sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Lists left empty keep their centroid
+            np.divide(sums, norms, out=centroids, where=norms > 0)
+        return centroids
+
+    def save(self, path):
+        """Save the trained centroids, see `load`."""
+
+        tmp = f'{path}.{os.getpid()}.tmp.npy'
+        np.save(tmp, self.centroids)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, vectors, n_probe=8):
+        """Index of the same vectors an index was saved with, without training it again."""
+
+        return cls(vectors, n_probe=n_probe, centroids=np.load(path))
+
+    def search(self, queries, k=1):
+        """Same as `ExactIndex.search`, but only over the probed buckets."""
+
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        # Bucket by bucket, every query probing a bucket is compared with its vectors at once
+        probe_queries, probe_lists = np.repeat(np.arange(len(queries)), n_probe), probes.ravel()
+        order = np.argsort(probe_lists, kind='stable')
+        bounds = np.searchsorted(probe_lists[order], np.arange(len(self.centroids) + 1))
+        for c in range(len(self.centroids)):
+            members = self.order[self.offsets[c]:self.offsets[c + 1]]
+            qs = probe_queries[order[bounds[c]:bounds[c + 1]]]
+            if len(members) == 0 or len(qs) == 0:
+                continue
+            block = queries[qs] @ self.vectors[members].T
+            scores[qs], ids[qs] = _merge_top_k(scores[qs], ids[qs], block, np.broadcast_to(members, block.shape), k)
+        return scores, ids
+
+
+def _pad(scores, ids, k):
+    missing = k - scores.shape[1]
+    if missing > 0:
+        scores = np.pad(scores, ((0, 0), (0, missing)), constant_values=-np.inf)
+        ids = np.pad(ids, ((0, 0), (0, missing)), constant_values=-1)
+    return scores, ids
+
+
+INDEX_BACKENDS = {
+    'exact': ExactIndex,
+    'ivf': IVFIndex,
+}
+
+
+def recall_at_k(approx_ids, exact_ids):
+    """Fraction of the exact top-k neighbours that the approximate search also found."""
+
+    found = sum(len(set(a[a >= 0]) & set(e[e >= 0])) for a, e in zip(approx_ids, exact_ids))
+    total = sum(len(e[e >= 0]) for e in exact_ids)
+    return found / total if total else 1.0
+
+
+def _normalized(rng, n, dim, clusters):
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(clusters, size=n)] + 0.3 * rng.normal(size=(n, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+if __name__ == '__main__':
+    import time
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    vectors = _normalized(rng, 20000, 64, 50)
+    queries = _normalized(rng, 500, 64, 50)
+
+    # Unit test: Exact search agrees with a plain matrix product
+    exact = ExactIndex(vectors)
+    scores, ids = exact.search(queries, k=5)
+    full = queries @ vectors.T
+    assert np.array_equal(ids[:, 0], full.argmax(axis=1))
+    assert np.allclose(scores[:, 0], full.max(axis=1))
+    assert np.all(scores[:, :-1] >= scores[:, 1:])
+
+    # Unit test: Probing every bucket is exact, and results are padded when there are fewer than k vectors
+    ivf = IVFIndex(vectors[:200], n_lists=10, n_probe=10)
+    assert recall_at_k(ivf.search(queries, k=5)[1], ExactIndex(vectors[:200]).search(queries, k=5)[1]) == 1.0
+    scores, ids = ExactIndex(vectors[:3]).search(queries, k=5)
+    assert ids.shape == (500, 5) and np.all(ids[:, 3:] == -1)
+
+    # Unit test: A loaded index searches the same as the saved one
+    path = os.path.join(tempfile.mkdtemp(), 'ivf.npy')
+    ivf.save(path)
+    loaded = IVFIndex.load(path, vectors[:200], n_probe=3)
+    ivf.n_probe = 3
+    assert np.array_equal(loaded.search(queries, k=5)[1], ivf.search(queries, k=5)[1])
+    os.remove(path)
+
+    # Benchmark: Recall and speed of IVF against exact search, including the time to build the index
+    vectors = _normalized(rng, 200000, 300, 500)
+    queries = _normalized(rng, 2000, 300, 500)
+    start = time.perf_counter()
+    _, exact_ids = ExactIndex(vectors).search(queries, k=10)
+    print(f'exact: {(time.perf_counter() - start) * 1000:.0f} ms')
+    start = time.perf_counter()
+    ivf = IVFIndex(vectors)
+    build_time = time.perf_counter() - start
+    print(f'ivf build: {build_time * 1000:.0f} ms')
+    path = os.path.join(tempfile.mkdtemp(), 'ivf.npy')
+    ivf.save(path)
+    start = time.perf_counter()
+    IVFIndex.load(path, vectors)
+    print(f'ivf build from saved centroids: {(time.perf_counter() - start) * 1000:.0f} ms')
+    os.remove(path)
+    for n_probe in [1, 4, 8, 16]:
+        ivf.n_probe = n_probe
+        start = time.perf_counter()
+        _, ivf_ids = ivf.search(queries, k=10)
+        ivf_time = time.perf_counter() - start
+        print(f'ivf n_probe={n_probe}: recall@10 {recall_at_k(ivf_ids, exact_ids):.3f}, '
+              f'{ivf_time * 1000:.0f} ms search, {(build_time + ivf_time) * 1000:.0f} ms with build')
+
+    print('All unit tests passed.')
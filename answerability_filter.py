@@ -1,26 +1,107 @@
 import os
 import re
+import sys
 import json
+import glob
 import math
 
-from common import DATA_DIR
+from ann import INDEX_BACKENDS, IVFIndex, TRAIN_POINTS_PER_LIST
+from cache import make_key
+from common import DATA_DIR, content_hash
+from embedding_store import EmbeddingStore, sentence_key
+from xutil import load_dataset
 
-import nltk
 import gensim
 from gensim.models.keyedvectors import KeyedVectors
 import numpy as np
-from nltk.corpus import stopwords
 
 
-nltk.download('stopwords')
-stop_words = stopwords.words('english')
+# NLTK's English stopwords, bundled so that nothing is downloaded at runtime
+STOP_WORDS = frozenset("""
+i me my myself we our ours ourselves you you're you've you'll you'd your yours yourself yourselves he him his
+himself she she's her hers herself it it's its itself they them their theirs themselves what which who whom
+this that that'll these those am is are was were be been being have has had having do does did doing a an the
+and but if or because as until while of at by for with about against between into through during before after
+above below to from up down in out on off over under again further then once here there when where why how
+all any both each few more most other some such no nor not only own same so than too very s t can will just
+don don't should should've now d ll m o re ve y ain aren aren't couldn couldn't didn didn't doesn doesn't
+hadn hadn't hasn hasn't haven haven't isn isn't ma mightn mightn't mustn mustn't needn needn't shan shan't
+shouldn shouldn't wasn wasn't weren weren't won won't wouldn wouldn't
+""".split())
+stop_words = STOP_WORDS
 
+ANSWERABILITY_THRESHOLD = 0.82
 
-model = KeyedVectors.load_word2vec_format(
-    # Download here: https://fasttext.cc/docs/en/english-vectors.html
-    os.path.join(DATA_DIR, "wiki-news-300d-1M-subword.vec"),
-    binary=False
-)
+# Number of questions embedded and searched at once
+DEFAULT_BATCH_SIZE = 1024
+
+
+# Download here: https://fasttext.cc/docs/en/english-vectors.html
+MODEL_FILE = "wiki-news-300d-1M-subword.vec"
+
+# Identifies stored sentence embeddings, bump the version whenever `embed_phrases` changes
+MODEL_ID = f"{os.path.splitext(MODEL_FILE)[0]}-v1"
+
+# Word vectors are converted once from the text format to gensim's native format, which can be memory-mapped
+MODEL_CACHE = f"{os.path.splitext(MODEL_FILE)[0]}.kv"
+# Versioned, as earlier pruned models were saved with a block of empty, unnamed rows
+PRUNED_MODEL_CACHE = f"{os.path.splitext(MODEL_FILE)[0]}.pruned-v2.kv"
+
+_model = None
+
+
+def _load_full_model():
+    path = os.path.join(DATA_DIR, MODEL_CACHE)
+    if not os.path.isfile(path):
+        print("Converting word vectors, this is only done once...")
+        KeyedVectors.load_word2vec_format(os.path.join(DATA_DIR, MODEL_FILE), binary=False).save(path)
+    # Memory-mapped read-only, so worker processes share the same pages
+    return KeyedVectors.load(path, mmap="r")
+
+
+def _load_pruned_model(vocabulary):
+    """Word vectors restricted to `vocabulary`, rebuilt only when the vocabulary grows.
+
+    Words outside the vocabulary are unknown in the full model too, so embeddings of phrases made of these words
+    do not change.
+    """
+
+    path = os.path.join(DATA_DIR, PRUNED_MODEL_CACHE)
+    vocab_path = f"{path}.vocab.json"
+    if os.path.isfile(path) and os.path.isfile(vocab_path):
+        with open(vocab_path) as f:
+            covered = set(json.load(f))
+        if vocabulary <= covered:
+            return KeyedVectors.load(path, mmap="r")
+        vocabulary = vocabulary | covered
+
+    full = _load_full_model()
+    keys = sorted(word for word in vocabulary if word in full.key_to_index)
+    # Empty, add_vectors appends after any preallocated rows
+    pruned = KeyedVectors(full.vector_size)
+    pruned.add_vectors(keys, full[keys])
+    pruned.save(path)
+    with open(vocab_path, "w") as f:
+        json.dump(sorted(vocabulary), f)
+    return KeyedVectors.load(path, mmap="r")
+
+
+def load_model(vocabulary=None):
+    """Load the word vectors, pruned to the given set of words if any."""
+
+    global _model
+    _model = _load_full_model() if vocabulary is None else _load_pruned_model(vocabulary)
+    return _model
+
+
+def get_model():
+    if _model is None:
+        load_model()
+    return _model
+
+
+def tokenize(phrase):
+    return [word for word in phrase.lower().split() if word not in stop_words]
 
 
 def get_documents(documents):
@@ -35,9 +116,21 @@ def get_documents(documents):
     return file_sentences
 
 
+def dataset_vocabulary(qa_json):
+    """All words that are looked up when scoring a dataset."""
+
+    vocabulary = set()
+    for sentences in get_documents(qa_json["documents"]).values():
+        for sentence in sentences:
+            vocabulary.update(tokenize(sentence))
+    for qa_pair in qa_json["qa_pairs"]:
+        vocabulary.update(tokenize(qa_pair["title"]))
+    return vocabulary
+
+
 def phrase_2_vec(phrase):
-    phrase = phrase.lower()
-    wordsInPhrase = [word for word in phrase.split() if word not in stop_words]
+    model = get_model()
+    wordsInPhrase = tokenize(phrase)
 
     vectorSet = []
     for aWord in wordsInPhrase:
@@ -63,6 +156,117 @@ def get_sent_vector(sent1, sent2):
     return cosine_similarity(phrase_2_vec(sent1), phrase_2_vec(sent2))
 
 
+def embed_phrases(phrases):
+    """Embed phrases (same as `phrase_2_vec`) as L2-normalized rows of a matrix.
+
+    Phrases without any known words get a zero row, so their similarity to anything is 0.
+    """
+
+    model = get_model()
+    matrix = np.zeros((len(phrases), model.vector_size), dtype=np.float32)
+    for i, phrase in enumerate(phrases):
+        words = [word for word in tokenize(phrase) if word in model.key_to_index]
+        if words:
+            matrix[i] = np.mean(model[words], axis=0)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+class AnswerabilityScorer:
+    """Vectorized `get_answerability`: `fit` once with the course documents, then `score` QA pairs in batches.
+
+    Word vectors, sentence embeddings and the per-course indexes are loaded on first use and kept, so a long-lived
+    scorer only pays for them once. `index` is a backend of `ann.INDEX_BACKENDS`, built with `index_args`. With
+    `use_store`, sentence embeddings are persisted in an `EmbeddingStore` and reused across runs.
+    """
+
+    def __init__(self, threshold=ANSWERABILITY_THRESHOLD, index="exact", use_store=True, **index_args):
+        if index not in INDEX_BACKENDS:
+            raise ValueError(f'Unknown index "{index}", should be one of: {", ".join(INDEX_BACKENDS)}')
+        self.threshold = threshold
+        self.index = index
+        self.index_args = index_args
+        self.use_store = use_store
+        self.file_sentences = {}
+        self._store = None
+        self._indexes = {}  # Course -> (unique sentences, index)
+
+    def fit(self, documents):
+        self.file_sentences = get_documents(documents)
+        self._indexes = {}
+        return self
+
+    def _course_index(self, course):
+        if course not in self._indexes:
+            # Repeated sentences (e.g. boilerplate) do not change the max, embed them only once
+            sentences = list(dict.fromkeys(self.file_sentences[course]))
+            if self.use_store:
+                if self._store is None:
+                    self._store = EmbeddingStore(MODEL_ID, get_model().vector_size)
+                vectors = self._store.lookup(sentences, embed_phrases)
+            else:
+                vectors = embed_phrases(sentences)
+            self._indexes[course] = (sentences, self._build_index(course, sentences, vectors))
+        return self._indexes[course]
+
+    def _build_index(self, course, sentences, vectors):
+        if self.index != "ivf" or not self.use_store:
+            return INDEX_BACKENDS[self.index](vectors, **self.index_args)
+
+        # Trained centroids are kept next to the stored embeddings, keyed by the sentences and training arguments.
+        # Only the latest centroids of a course are kept, those of its previous sentences are deleted.
+        train_args = {k: v for k, v in self.index_args.items() if k != "n_probe"}
+        sentences_hash = content_hash("\n".join(sentence_key(s) for s in sentences).encode("utf-8"))
+        key = make_key(sentences_hash, train_args, TRAIN_POINTS_PER_LIST)
+        folder = os.path.join(self._store.root, "ivf", course)
+        path = os.path.join(folder, f"{key}.npy")
+        n_probe = self.index_args.get("n_probe", 8)
+        if os.path.isfile(path):
+            return IVFIndex.load(path, vectors, n_probe=n_probe)
+        index = IVFIndex(vectors, **self.index_args)
+        os.makedirs(folder, exist_ok=True)
+        index.save(path)
+        for stale in glob.glob(os.path.join(folder, "*.npy")):
+            if stale != path:
+                os.remove(stale)
+        return index
+
+    def search(self, qa_pairs, k=1, batch_size=DEFAULT_BATCH_SIZE):
+        """Top-k most similar course sentences of every answerable QA pair, as a list of (sentence, similarity).
+
+        QA pairs that are not scored (not answerable, or of a course without documents) get None.
+        """
+
+        results = [None] * len(qa_pairs)
+
+        by_course = {}
+        for i, pair in enumerate(qa_pairs):
+            if pair["is_answerable"] == True and pair["course"] in self.file_sentences:
+                by_course.setdefault(pair["course"], []).append(i)
+
+        for course, indices in by_course.items():
+            sentences, index = self._course_index(course)
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                scores, ids = index.search(embed_phrases([qa_pairs[i]["title"] for i in batch]), k)
+                for i, row_scores, row_ids in zip(batch, scores, ids):
+                    results[i] = [(sentences[j], float(score)) for score, j in zip(row_scores, row_ids) if j >= 0]
+
+        return results
+
+    def decide(self, pair, top):
+        """Answerability of a QA pair given its `search` result."""
+
+        return pair["is_answerable"] if top is None else bool(top and top[0][1] > self.threshold)
+
+    def score(self, qa_pairs, batch_size=DEFAULT_BATCH_SIZE):
+        """Answerability of every QA pair."""
+
+        return [self.decide(pair, top) for pair, top in zip(qa_pairs, self.search(qa_pairs, 1, batch_size))]
+
+
 def get_answerability(file_sentences, post):
     title = post["title"]
     course = post["course"]
@@ -73,17 +277,116 @@ def get_answerability(file_sentences, post):
         if sentences is not None:
             similarity = [(i, get_sent_vector(sent, title)) for i, sent in enumerate(sentences)]
             max_similarity = max(similarity, key=lambda x: x[1])[1]
-            return max_similarity > 0.82
+            return max_similarity > ANSWERABILITY_THRESHOLD
 
     return is_answerable
 
 
-with open(os.path.join(DATA_DIR, "parrot-qa.json"), "r") as f:
-    qa_json = json.load(f)
+def _scorer(args):
+    index_args = {"n_lists": args.n_lists, "n_probe": args.n_probe} if args.index == "ivf" else {}
+    return AnswerabilityScorer(index=args.index, **index_args)
+
+
+def _load_dataset(args):
+    qa_json = load_dataset(args.input)
+    if args.prune:
+        load_model(vocabulary=dataset_vocabulary(qa_json))
+    return qa_json
+
+
+def filter_dataset(args):
+    qa_json = _load_dataset(args)
+    scorer = _scorer(args).fit(qa_json["documents"])
+    qa_pairs = qa_json["qa_pairs"]
+    for qa_pair, top in zip(qa_pairs, scorer.search(qa_pairs, max(args.top_k, 1), args.batch_size)):
+        if top is None:
+            continue
+        qa_pair["is_answerable"] = scorer.decide(qa_pair, top)
+        if args.top_k:
+            qa_pair["support"] = [{"text": sentence, "similarity": score} for sentence, score in top]
+
+    with open(args.output, "w") as f:
+        json.dump(qa_json, f, indent=4)
+
+
+def benchmark(args):
+    """Compare the --index backend against exact search: recall of the top-k sentences, and agreement of the
+    answerability decisions (exact search decides the same as `get_answerability`)."""
+
+    import time
+
+    qa_json = _load_dataset(args)
+    qa_pairs = qa_json["qa_pairs"]
+    k = args.top_k or 10
+
+    results = []
+    for scorer in [AnswerabilityScorer(), _scorer(args)]:
+        start = time.perf_counter()
+        scorer.fit(qa_json["documents"])
+        results.append(scorer.search(qa_pairs, k, args.batch_size))
+        results.append(time.perf_counter() - start)
+    exact, exact_time, approx, approx_time = results
+
+    scored = [(pair, e, a) for pair, e, a in zip(qa_pairs, exact, approx) if e is not None]
+    # Sentences are compared by text, they are unique within a course
+    found = sum(len({s for s, _ in a} & {s for s, _ in e}) for _, e, a in scored)
+    total = sum(len(e) for _, e, _ in scored)
+    agree = sum(scorer.decide(pair, e) == scorer.decide(pair, a) for pair, e, a in scored)
+
+    print(f"Scored {len(scored)} QA pairs")
+    print(f"exact: {exact_time:.2f}s, {args.index}: {approx_time:.2f}s")
+    print(f"recall@{k}: {found / total if total else 1.0:.4f}")
+    print(f"answerability agreement: {agree / len(scored) if scored else 1.0:.4f}")
+
+
+def run_worker(args):
+    """Score QA pairs read as JSON lines from stdin, writing each back with its answerability as soon as it is
+    scored. The documents of --input are loaded once."""
+
+    if args.prune:
+        # The pruned vocabulary only covers --input, so words of the QA pairs read later would go missing
+        raise ValueError("--prune cannot be used with worker, QA pairs read from stdin need the full word vectors")
+    qa_json = _load_dataset(args)
+    scorer = _scorer(args).fit(qa_json["documents"])
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        qa_pair = json.loads(line)
+        top = scorer.search([qa_pair], max(args.top_k, 1))[0]
+        qa_pair["is_answerable"] = scorer.decide(qa_pair, top)
+        if args.top_k and top is not None:
+            qa_pair["support"] = [{"text": sentence, "similarity": score} for sentence, score in top]
+        print(json.dumps(qa_pair), flush=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default=os.path.join(DATA_DIR, "parrot-qa.json"),
+                        help="dataset to score, a JSON file or a sharded directory exported by xutil")
+    parser.add_argument("--prune", action="store_true",
+                        help="use word vectors pruned to the dataset vocabulary, not supported by worker")
+    parser.add_argument("--index", choices=sorted(INDEX_BACKENDS), default="exact",
+                        help="nearest-neighbour search over course sentences, ivf is approximate but faster")
+    parser.add_argument("--n-lists", type=int, help="ivf: number of clusters, defaults to sqrt(#sentences)")
+    parser.add_argument("--n-probe", type=int, default=8, help="ivf: clusters searched per question, more is "
+                                                               "slower but closer to exact")
+    parser.add_argument("--top-k", type=int, default=0, help="store the k most similar sentences of every "
+                                                             "scored QA pair under \"support\"")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="questions scored at once")
+    parser.set_defaults(func=filter_dataset, output=os.path.join(DATA_DIR, "parrot-qa-filtered.json"))
+    subparsers = parser.add_subparsers(dest="command")
+
+    f_parser = subparsers.add_parser("filter", help="score a dataset and write the filtered copy (default)")
+    f_parser.add_argument("--output", default=os.path.join(DATA_DIR, "parrot-qa-filtered.json"))
+    f_parser.set_defaults(func=filter_dataset)
+
+    b_parser = subparsers.add_parser("benchmark", help="compare --index against exact search")
+    b_parser.set_defaults(func=benchmark)
 
-file_sentences = get_documents(qa_json['documents'])
-for qa_pair in qa_json["qa_pairs"]:
-    qa_pair["is_answerable"] = bool(get_answerability(file_sentences, qa_pair))
+    w_parser = subparsers.add_parser("worker", help="score QA pairs given as JSON lines on stdin")
+    w_parser.set_defaults(func=run_worker)
 
-with open(os.path.join(DATA_DIR, "parrot-qa-filtered.json"), "w") as f:
-    json.dump(qa_json, f, indent=4)
+    args = parser.parse_args()
+    args.func(args)
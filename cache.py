@@ -0,0 +1,93 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+
+from common import DATA_DIR, write_atomic
+
+
+DEFAULT_MAX_ENTRIES = 5000
+
+
+def make_key(*parts):
+    """Stable hash of JSON-serializable key parts (dict ordering does not matter)."""
+
+    blob = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class JsonCache:
+    """Persistent store of JSON values under .cache/cache/<namespace>/<group>/<key>.json.
+
+    Entries are evicted least-recently-used first, a hit refreshes the entry's modified time.
+    """
+
+    def __init__(self, namespace, max_entries=DEFAULT_MAX_ENTRIES):
+        self.root = os.path.join(DATA_DIR, 'cache', namespace)
+        self.max_entries = max_entries
+
+    def _path(self, group, key):
+        return os.path.join(self.root, group, f'{key}.json')
+
+    def get(self, group, key):
+        path = self._path(group, key)
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                value = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        os.utime(path)
+        return value
+
+    def put(self, group, key, value):
+        path = self._path(group, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, json.dumps(value).encode('utf-8'))
+
+    def invalidate(self, group=None):
+        """Drop all entries of a group, or the whole namespace."""
+
+        path = os.path.join(self.root, group) if group else self.root
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    def prune(self, max_entries=None):
+        """Evict the least recently used entries beyond `max_entries`, returns the number evicted."""
+
+        max_entries = self.max_entries if max_entries is None else max_entries
+        entries = glob.glob(os.path.join(self.root, '*', '*.json'))
+        if len(entries) <= max_entries:
+            return 0
+
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[max_entries:]:
+            os.remove(path)
+        return len(entries) - max_entries
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    DATA_DIR = tempfile.mkdtemp()
+    cache = JsonCache('playground', max_entries=2)
+
+    # Unit test: Key is independent of dict ordering
+    assert make_key('a', {'x': 1, 'y': 2}) == make_key('a', {'y': 2, 'x': 1})
+
+    # Unit test: Round trip, miss and invalidation
+    cache.put('g', make_key(1), [{'title': 'a'}])
+    assert cache.get('g', make_key(1)) == [{'title': 'a'}]
+    assert cache.get('g', make_key(2)) is None
+    cache.invalidate('g')
+    assert cache.get('g', make_key(1)) is None
+
+    # Unit test: Eviction keeps the most recently used entries
+    for i in range(3):
+        cache.put('g', make_key(i), i)
+        os.utime(cache._path('g', make_key(i)), (i, i))
+    assert cache.prune() == 1
+    assert cache.get('g', make_key(0)) is None
+
+    shutil.rmtree(DATA_DIR)
+    print('All unit tests passed.')
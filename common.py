@@ -1,4 +1,9 @@
 import os
+import glob
+import json
+import shutil
+import hashlib
+import threading
 
 import pandas as pd
 
@@ -7,6 +12,8 @@ DATA_DIR = '.cache'
 
 MIN_DOCUMENT_TOKEN_COUNT = 10
 
+BLOB_DIR = 'blobs'
+
 
 class ArgsWrapper:
     """Wrap (key, value) arguments into properties."""
@@ -18,8 +25,8 @@ class ArgsWrapper:
 
 def setup_dir(collection, course):
     path = os.path.join(DATA_DIR, collection, course)
-    if not os.path.isdir(path):
-        os.makedirs(path)
+    # Concurrent downloads and parses may create the same folder
+    os.makedirs(path, exist_ok=True)
     return path
 
 
@@ -39,3 +46,128 @@ def validate_spec(df):
         return False
     else:
         return True
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_atomic(path, data):
+    """Write bytes via a temporary file, so readers never see a partially written file."""
+
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+
+
+class Manifest:
+    """Download state (validators, hashes, etc.) of every spec row of a course, keyed by name."""
+
+    def __init__(self, course, collection='materials'):
+        self.path = os.path.join(DATA_DIR, 'manifests', course, f'{collection}.json')
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as fp:
+                self.entries = json.load(fp)
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            return self.entries.get(name)
+
+    def update(self, name, entry):
+        with self._lock:
+            self.entries[name] = entry
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self.entries, indent=4, sort_keys=True)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_atomic(self.path, data.encode('utf-8'))
+
+
+def blob_path(digest, extn=''):
+    return os.path.join(DATA_DIR, BLOB_DIR, digest[:2], digest + extn)
+
+
+def put_blob(data, extn=''):
+    """Add bytes to the content-addressed store under .cache/blobs/, returns their sha256.
+
+    Identical bytes are stored once, however many courses or names they are linked from.
+    """
+
+    digest = content_hash(data)
+    path = blob_path(digest, extn)
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, data)
+    return digest
+
+
+def link_blob(digest, extn, dest):
+    """Make `dest` a hard link to a stored blob, or a copy where hard links are not supported.
+
+    The link replaces `dest` atomically, so writers must do the same (see `write_atomic`) rather than
+    write into `dest`, which would modify the blob.
+    """
+
+    src = blob_path(digest, extn)
+    if os.path.isfile(dest) and os.path.samefile(src, dest):
+        return
+    tmp = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def material_files(course, name, manifest=None):
+    """Local copies of a material, which should be exactly one.
+
+    Resolved through the course manifest (name -> extension and sha256), relinking the copy from the blob store
+    if it was removed, or none if the blob is gone too. Only materials the manifest does not know (not downloaded
+    by dlutil) are found by name, whatever their extension. `manifest` is the course `Manifest`, or a dict of its
+    entries, read from disk if not given.
+    """
+
+    folder = os.path.join(DATA_DIR, 'materials', course)
+    entry = (manifest if manifest is not None else Manifest(course)).get(name)
+    if entry is None:
+        return glob.glob(os.path.join(folder, f'{glob.escape(name)}.*'))
+
+    path = os.path.join(folder, name + entry['extn'])
+    if not os.path.isfile(path):
+        if not os.path.isfile(blob_path(entry['sha256'], entry['extn'])):
+            return []
+        setup_dir('materials', course)
+        link_blob(entry['sha256'], entry['extn'], path)
+    return [path]
+
+
+def prune_blobs():
+    """Remove blobs that no material links to or any manifest refers to, returns the number removed."""
+
+    referenced = set()
+    for manifest_path in glob.glob(os.path.join(DATA_DIR, 'manifests', '*', 'materials.json')):
+        with open(manifest_path) as fp:
+            referenced.update(entry['sha256'] + entry['extn'] for entry in json.load(fp).values())
+
+    removed = 0
+    for path in glob.glob(os.path.join(DATA_DIR, BLOB_DIR, '*', '*')):
+        # A blob with a single link is not linked from .cache/materials
+        if path.endswith('.tmp') or os.path.basename(path) in referenced:
+            continue
+        if os.stat(path).st_nlink == 1:
+            os.remove(path)
+            removed += 1
+    return removed
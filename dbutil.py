@@ -0,0 +1,479 @@
+import os
+import re
+import json
+import glob
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+from bson import json_util
+from pymongo.errors import OperationFailure
+
+import putil
+from common import DATA_DIR, read_spec, validate_spec, write_atomic, put_blob, link_blob, material_files, ArgsWrapper, Manifest
+from adapters import mongo
+
+
+# Raw materials and forums are large (up to mongo.INLINE_LIMIT when inline), so they are written in smaller
+# batches than parsed records
+RAW_BATCH_SIZE = 64
+
+DEFAULT_POLL_INTERVAL = 30
+
+# Collections of raw files, and the collections of what is parsed from them
+WATCHED = {'materials': 'documents', 'forums': 'qa_pairs'}
+
+
+def _local_file(collection, course, name):
+    if collection == 'materials':
+        paths = material_files(course, name)
+    else:
+        paths = glob.glob(os.path.join(DATA_DIR, collection, course, f'{glob.escape(name)}.*'))
+    if len(paths) == 0:
+        raise RuntimeError(f'Could not find {collection} "{name}", run dlutil first.')
+    elif len(paths) > 1:
+        raise RuntimeError(f'Multiple {collection} found for "{name}", please remove duplicates.')
+    return paths[0]
+
+
+def _ids_by_name(coll, course_id):
+    return {doc['name']: doc['_id'] for doc in coll.find({'course': course_id}, {'name': 1})}
+
+
+def _blobs_by_uri(coll, course_id):
+    """Stored blobs without their data, to skip unchanged files and clean up replaced ones."""
+
+    fields = {'uri': 1, 'blob.encoding': 1, 'blob.size': 1, 'blob.sha256': 1, 'blob.gridfs_id': 1}
+    return {doc['uri']: doc.get('blob') for doc in coll.find({'course': course_id}, fields)}
+
+
+def _local_rows(collection, course, df):
+    rows = []
+    for _, row in df.iterrows() if df is not None else []:
+        try:
+            rows.append((row, _local_file(collection, course, row['name'])))
+        except Exception as e:
+            print(f'Failed: {row["name"]}')
+            print(f'>', e)
+    return rows
+
+
+def _load_raw(db, coll, course_id, rows, batch_size, make_doc):
+    """Upsert the raw files of spec rows, storing each with `mongo.put_raw` unless it is unchanged."""
+
+    previous = _blobs_by_uri(coll, course_id)
+    with mongo.BulkUpserter(coll, ['uri'], batch_size) as upserter:
+        for row, path in rows:
+            blob = old = previous.get(row['uri'])
+            try:
+                blob = mongo.put_raw(db, path, previous=old)
+                doc = {**make_doc(row, path), 'course': course_id}
+                if blob is old:
+                    # An unchanged blob is left as stored, `old` is only its metadata
+                    upserter.add(doc)
+                else:
+                    doc['blob'] = blob
+                    doc['updated_at'] = datetime.now(timezone.utc)
+                    # Documents loaded before raw files were stored as blobs hold them in `raw`
+                    upserter.add(doc, unset=['raw'], tag=(old, blob))
+            except Exception as e:
+                print(f'Failed: {row["name"]}')
+                print(f'>', e)
+                if blob is not old:
+                    mongo.delete_raw(db, blob)
+
+    # A replaced blob is only deleted once its document points to the new one, else the new one is not referenced
+    for old, blob in upserter.succeeded:
+        if old is not None:
+            mongo.delete_raw(db, old)
+    for old, blob in upserter.failed:
+        mongo.delete_raw(db, blob)
+    return upserter
+
+
+def _document_record(course_id, material_id, doc):
+    return {'course': course_id, 'material': material_id, 'title': doc['title'], 'contents': doc['contents']}
+
+
+def _qa_record(course_id, forum_id, pair):
+    return {**pair, 'course': course_id, 'forum': forum_id}
+
+
+def _report(label, upserter):
+    print(f'{label}: {upserter.summary()}')
+    for error in upserter.errors:
+        print(f'>', error)
+
+
+def load_course(db, course, specs, batch_size=mongo.DEFAULT_BATCH_SIZE, validate=True):
+    """Upsert a course, its raw materials and forums, and their parsed documents and QA pairs.
+
+    `specs` maps a collection (materials, forums) to its spec dataframe. Rows without local files are reported
+    and skipped. See `mongo.ensure_collections` for `validate`.
+    """
+
+    colls = mongo.ensure_collections(db, validate=validate)
+    raw_batch_size = min(batch_size, RAW_BATCH_SIZE)
+
+    with mongo.BulkUpserter(colls['courses'], ['name'], batch_size) as upserter:
+        # The course URI is not part of the specs, keep any set by hand
+        upserter.add({'name': course}, insert_only={'uri': ''})
+    course_id = colls['courses'].find_one({'name': course})['_id']
+
+    rows = _local_rows('materials', course, specs.get('materials'))
+    upserter = _load_raw(db, colls['materials'], course_id, rows, raw_batch_size, lambda row, path: {
+        'name': row['name'], 'uri': row['uri'], 'type': os.path.splitext(path)[1][1:]})
+    _report('Materials', upserter)
+
+    rows = _local_rows('forums', course, specs.get('forums'))
+    upserter = _load_raw(db, colls['forums'], course_id, rows, raw_batch_size, lambda row, path: {
+        'name': row['name'], 'uri': row['uri'], 'type': 'piazza'})
+    _report('Forums', upserter)
+
+    material_ids = _ids_by_name(colls['materials'], course_id)
+    with mongo.BulkUpserter(colls['documents'], ['material', 'title'], batch_size) as upserter:
+        for name, material_id in material_ids.items():
+            path = os.path.join(DATA_DIR, 'documents', course, f'{name}.json')
+            if not os.path.isfile(path):
+                print(f'Skipped: {name}: not parsed, run putil first')
+                continue
+            with open(path) as fp:
+                for doc in json.load(fp):
+                    upserter.add(_document_record(course_id, material_id, doc))
+    _report('Documents', upserter)
+
+    forum_ids = _ids_by_name(colls['forums'], course_id)
+    with mongo.BulkUpserter(colls['qa_pairs'], ['course', 'id'], batch_size) as upserter:
+        for name, forum_id in forum_ids.items():
+            path = os.path.join(DATA_DIR, 'qa_pairs', course, f'{name}.json')
+            if not os.path.isfile(path):
+                print(f'Skipped: {name}: not parsed, run putil first')
+                continue
+            with open(path) as fp:
+                for pair in json.load(fp):
+                    upserter.add(_qa_record(course_id, forum_id, pair))
+    _report('QA pairs', upserter)
+
+
+def read_specs(spec_dir, course_pattern):
+    """Spec dataframes of every course matching the pattern: {course: {collection: dataframe}}."""
+
+    specs = {}
+    for spec_file in sorted(glob.glob(os.path.join(spec_dir, '*.*.csv'))):
+        course, collection, df = read_spec(spec_file)
+        if re.search(course_pattern, course) is None:
+            continue
+        if validate_spec(df) == False:
+            raise RuntimeError(f'Invalid spec: {spec_file}')
+        specs.setdefault(course, {})[collection] = df
+    return specs
+
+
+class Watcher:
+    """Reparse materials and forums as they change in the database, and upsert their documents and QA pairs.
+
+    Changes are read from a change stream. Without change streams (e.g. a standalone mongod), the collections are
+    polled on their updated_at index instead. Either position is saved in .cache/watch/<db>.json after every change,
+    so a restarted watcher resumes where it stopped. Changes that fail to process are kept there too, and retried
+    from the current document on every poll (or every poll interval with change streams) until they succeed.
+    Parsed files are also written to the local cache, with the pflags of the spec files.
+    """
+
+    def __init__(self, db, specs, batch_size=mongo.DEFAULT_BATCH_SIZE, validate=True):
+        self.db = db
+        self.colls = mongo.ensure_collections(db, validate=validate)
+        self.batch_size = batch_size
+        self.pflags = {}
+        for course, collections in specs.items():
+            for collection, df in collections.items():
+                for _, row in df.iterrows():
+                    if 'pflags' in row and not pd.isnull(row['pflags']):
+                        self.pflags[(course, collection, row['name'])] = json.loads(row['pflags'])
+        self.courses = {}
+
+        self.path = os.path.join(DATA_DIR, 'watch', f'{db.name}.json')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.state = {'resume_token': None, 'positions': {}}
+        if os.path.isfile(self.path):
+            with open(self.path) as fp:
+                self.state = json_util.loads(fp.read())
+        self.state.setdefault('failed', [])  # [collection, _id] pairs
+
+    def _save(self):
+        write_atomic(self.path, json_util.dumps(self.state).encode('utf-8'))
+
+    def _course_name(self, course_id):
+        if course_id not in self.courses:
+            self.courses[course_id] = self.colls['courses'].find_one({'_id': course_id})['name']
+        return self.courses[course_id]
+
+    def _write_raw(self, collection, course, doc):
+        """Write the raw file to the local cache, where the parsers read it from."""
+
+        with mongo.open_raw(self.db, doc) as fp:
+            data = fp.read()
+        if collection == 'materials':
+            extn = f'.{doc["type"]}'
+        else:
+            # Forums are dumped as JSON Lines, or as a JSON list by older downloads
+            extn = '.json' if data.lstrip()[:1] == b'[' else '.jsonl'
+
+        outdir = os.path.join(DATA_DIR, collection, course)
+        os.makedirs(outdir, exist_ok=True)
+        for stale in glob.glob(os.path.join(outdir, f'{glob.escape(doc["name"])}.*')):
+            if not stale.endswith(extn):
+                os.remove(stale)
+        if collection == 'materials':
+            digest = put_blob(data, extn)
+            link_blob(digest, extn, os.path.join(outdir, doc['name'] + extn))
+            # Materials are resolved through the manifest, which must name this copy rather than the downloaded one
+            manifest = Manifest(course)
+            entry = manifest.get(doc['name'])
+            if entry is not None and (entry['sha256'], entry['extn']) != (digest, extn):
+                # Dropping the validators makes the next download a full one, rather than revalidate this copy
+                manifest.update(doc['name'], {**entry, 'extn': extn, 'sha256': digest, 'size': len(data),
+                                              'etag': None, 'last_modified': None})
+                manifest.save()
+        else:
+            write_atomic(os.path.join(outdir, doc['name'] + extn), data)
+
+    def process(self, collection, doc):
+        course = self._course_name(doc['course'])
+        self._write_raw(collection, course, doc)
+
+        args = ArgsWrapper(course=course, name=doc['name'], pflags=self.pflags.get((course, collection, doc['name']), {}))
+        target = self.colls[WATCHED[collection]]
+        if collection == 'materials':
+            records = [_document_record(doc['course'], doc['_id'], span) for span in putil.parse_material(args)]
+            keys, parent = ['material', 'title'], 'material'
+        else:
+            records = [_qa_record(doc['course'], doc['_id'], pair) for pair in putil.parse_forum(args)]
+            keys, parent = ['course', 'id'], 'forum'
+
+        with mongo.BulkUpserter(target, keys, self.batch_size) as upserter:
+            for record in records:
+                upserter.add(record)
+        # Records no longer produced by the parser
+        removed = target.delete_many({parent: doc['_id'], keys[-1]: {'$nin': [r[keys[-1]] for r in records]}})
+        print(f'Reparsed: {course} {doc["name"]}: {upserter.summary()}, {removed.deleted_count} removed')
+
+    def delete(self, collection, doc_id):
+        parent = 'material' if collection == 'materials' else 'forum'
+        removed = self.colls[WATCHED[collection]].delete_many({parent: doc_id})
+        print(f'Deleted: {collection} {doc_id}: {removed.deleted_count} removed')
+
+    def handle(self, collection, doc_id, doc):
+        """Process a changed document, or the deletion of one if `doc` is None, keeping track of failures."""
+
+        key = [collection, doc_id]
+        try:
+            if doc is None:
+                self.delete(collection, doc_id)
+            else:
+                self.process(collection, doc)
+        except Exception as e:
+            print(f'Failed: {collection} {doc_id}')
+            print(f'>', e)
+            if key not in self.state['failed']:
+                self.state['failed'].append(key)
+            return
+        if key in self.state['failed']:
+            self.state['failed'].remove(key)
+
+    def retry_failed(self):
+        for collection, doc_id in list(self.state['failed']):
+            self.handle(collection, doc_id, self.colls[collection].find_one({'_id': doc_id}))
+        self._save()
+
+    def run_stream(self, interval=DEFAULT_POLL_INTERVAL):
+        with mongo.watch(self.db, WATCHED, resume_after=self.state['resume_token']) as stream:
+            print('Watching for changes...')
+            self.retry_failed()
+            last_retry = time.monotonic()
+            while stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    if self.state['failed'] and time.monotonic() - last_retry >= interval:
+                        self.retry_failed()
+                        last_retry = time.monotonic()
+                    continue
+                collection = change['ns']['coll']
+                if change['operationType'] == 'delete':
+                    self.handle(collection, change['documentKey']['_id'], None)
+                elif change.get('fullDocument') is not None:
+                    # Missing if the document was deleted since, its deletion comes next
+                    self.handle(collection, change['documentKey']['_id'], change['fullDocument'])
+                self.state['resume_token'] = stream.resume_token
+                self._save()
+
+    def poll(self):
+        """Retry the failed documents, and process those updated since the last poll, returns how many were."""
+
+        count = len(self.state['failed'])
+        self.retry_failed()
+        for collection in WATCHED:
+            since = self.state['positions'].get(collection)
+            for doc in mongo.poll_updates(self.colls[collection], tuple(since) if since else None):
+                self.handle(collection, doc['_id'], doc)
+                self.state['positions'][collection] = [doc['updated_at'], doc['_id']]
+                self._save()
+                count += 1
+        return count
+
+    def run(self, interval=DEFAULT_POLL_INTERVAL, once=False):
+        if not once:
+            try:
+                self.run_stream(interval)
+                return
+            except OperationFailure as e:
+                print('Change streams are unavailable, polling for updates instead.')
+                print(f'>', e)
+
+        while True:
+            count = self.poll()
+            if once:
+                print(f'Processed {count} updates.')
+                return
+            time.sleep(interval)
+
+
+def watch_database(args):
+    db = mongo.connect(args.db, uri=args.uri)
+    Watcher(db, read_specs(args.spec_dir, r'.*'), args.batch_size).run(args.interval, args.once)
+
+
+def load_database(args):
+    db = mongo.connect(args.db, uri=args.uri)
+    for course, specs in read_specs(args.spec_dir, args.course).items():
+        print(f'\nLoading {course}')
+        load_course(db, course, specs, args.batch_size)
+
+
+def init_database(args):
+    db = mongo.connect(args.db, uri=args.uri)
+    colls = mongo.ensure_collections(db)
+    print(f'Collections ready: {", ".join(colls)}')
+
+
+def run_tests(args):
+    """Unit tests of the loader, against mongomock in a temporary data folder."""
+
+    import shutil
+    import tempfile
+    import mongomock
+    import mongomock.gridfs
+
+    mongomock.gridfs.enable_gridfs_integration()
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        for folder, name, data in [('materials', 'a.html', '<html>a</html>'), ('forums', 'p.jsonl', '{}\n'),
+                                   ('documents', 'a.json', '[{"title": "A", "contents": []}]'),
+                                   ('qa_pairs', 'p.json', '[{"id": "q1", "subject": "Q"}]')]:
+            os.makedirs(os.path.join(DATA_DIR, folder, 'X'), exist_ok=True)
+            with open(os.path.join(DATA_DIR, folder, 'X', name), 'w') as fp:
+                fp.write(data)
+        specs = {'materials': pd.DataFrame({'name': ['a'], 'uri': ['https://x/a']}),
+                 'forums': pd.DataFrame({'name': ['p'], 'uri': ['https://piazza.com/class/p']})}
+        db = mongomock.MongoClient().db
+
+        # Unit test: Loading inserts every record, and loading again changes nothing
+        # The material was loaded before raw files were stored as blobs
+        db.materials.insert_one({'uri': 'https://x/a', 'raw': '<html>old</html>'})
+        load_course(db, 'X', specs, validate=False)
+        names = ['courses', 'materials', 'forums', 'documents', 'qa_pairs']
+        assert [db[name].count_documents({}) for name in names] == [1] * len(names)
+        stored = db.materials.find_one()
+        assert 'raw' not in stored
+        load_course(db, 'X', specs, validate=False)
+        assert db.materials.find_one() == stored
+        with mongo.open_raw(db, stored) as fp:
+            assert fp.read() == b'<html>a</html>'
+
+        # Unit test: A replaced blob is only deleted once its document points to the new one
+        def replace_material(size):
+            data = os.urandom(size)
+            with open(os.path.join(DATA_DIR, 'materials', 'X', 'a.html'), 'wb') as fp:
+                fp.write(data)
+            load_course(db, 'X', specs, validate=False)
+            return data
+
+        size = 2 * mongo.INLINE_LIMIT
+        first = replace_material(size)
+        # The next update of a conflicts with this document on a unique index, so that it fails
+        db.materials.insert_one({'uri': 'conflict', 'blob': {'size': size + 1}})
+        db.materials.create_index('blob.size', unique=True, sparse=True)
+        replace_material(size + 1)
+        with mongo.open_raw(db, db.materials.find_one({'uri': 'https://x/a'})) as fp:
+            assert fp.read() == first
+        assert db['raw.files'].count_documents({}) == 1
+        db.materials.delete_one({'uri': 'conflict'})
+        second = replace_material(size + 2)
+        with mongo.open_raw(db, db.materials.find_one({'uri': 'https://x/a'})) as fp:
+            assert fp.read() == second
+        assert db['raw.files'].count_documents({}) == 1
+
+        # Unit test: A change that failed to process is retried on the next poll, until it succeeds
+        calls = []
+
+        def flaky_parse(args):
+            calls.append(args.name)
+            if len(calls) == 1:
+                raise RuntimeError('Transient failure')
+            return [{'id': 'q1', 'title': 'B', 'contents': []}]
+
+        parse_material, parse_forum = putil.parse_material, putil.parse_forum
+        putil.parse_material = putil.parse_forum = flaky_parse
+        # The manifest still names an earlier download, which the watcher replaces with the stored material
+        manifest = Manifest('X')
+        manifest.update('a', {'uri': 'https://x/a', 'extn': '.html', 'sha256': '0' * 64, 'etag': 'e'})
+        manifest.save()
+        try:
+            watcher = Watcher(db, {'X': specs}, validate=False)
+            assert watcher.poll() == 2 and watcher.state['failed'] == [['materials', stored['_id']]]
+            entry = Manifest('X').get('a')
+            assert entry['sha256'] == db.materials.find_one({'uri': 'https://x/a'})['blob']['sha256']
+            assert entry['etag'] is None
+            assert material_files('X', 'a') == [os.path.join(DATA_DIR, 'materials', 'X', 'a.html')]
+            assert Watcher(db, {'X': specs}, validate=False).poll() == 1 and calls == ['a', 'p', 'a']
+            assert json_util.loads(open(watcher.path).read())['failed'] == []
+            assert db.documents.find_one({'material': stored['_id'], 'title': 'B'}) is not None
+        finally:
+            putil.parse_material, putil.parse_forum = parse_material, parse_forum
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+    print('All unit tests passed.')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='test', help='name of the database')
+    parser.add_argument('--uri', help='MongoDB URI, e.g. mongodb://localhost:27017, defaults to the cluster')
+    subparsers = parser.add_subparsers(dest='command')
+
+    i_parser = subparsers.add_parser('init')
+    i_parser.set_defaults(func=init_database)
+
+    l_parser = subparsers.add_parser('load')
+    l_parser.add_argument('spec_dir', help='folder containing specification files named <course>.<collection>.csv')
+    l_parser.add_argument('--course', default=r'.*', help='regex to filter by course name')
+    l_parser.add_argument('--batch-size', type=int, default=mongo.DEFAULT_BATCH_SIZE, help='upserts per bulk write')
+    l_parser.set_defaults(func=load_database)
+
+    w_parser = subparsers.add_parser('watch')
+    w_parser.add_argument('spec_dir', help='folder containing specification files, for the pflags of every row')
+    w_parser.add_argument('--batch-size', type=int, default=mongo.DEFAULT_BATCH_SIZE, help='upserts per bulk write')
+    w_parser.add_argument('--interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                          help='seconds between polls, when change streams are unavailable')
+    w_parser.add_argument('--once', action='store_true', help='poll for updates once and exit')
+    w_parser.set_defaults(func=watch_database)
+
+    t_parser = subparsers.add_parser('test', help='run the unit tests against mongomock')
+    t_parser.set_defaults(func=run_tests)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,198 @@
+import re
+import zlib
+
+import numpy as np
+
+
+DEFAULT_NUM_PERM = 128
+
+# Texts are compared as sets of word n-grams of this size
+SHINGLE_SIZE = 3
+
+# Mersenne prime of the universal hash functions the signatures are computed with
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Candidates are verified on their signatures, so missing a near-duplicate costs more than a false candidate
+FALSE_NEGATIVE_WEIGHT = 0.9
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """Set of word n-grams of a lowercased text, or the whole text if it has fewer than `size` words."""
+
+    words = re.findall(r'\w+', text.lower())
+    if len(words) <= size:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """MinHash signatures: for each of `num_perm` random hash functions, the minimum hash over a set of shingles.
+
+    The fraction of equal positions in two signatures estimates the Jaccard similarity of the sets.
+    """
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, seed=0):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(1, _MAX_HASH, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _MAX_HASH, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        hashes = np.array([zlib.crc32(s.encode('utf-8')) for s in shingles(text)], dtype=np.uint64)
+        # Products fit in 64 bits as both factors are below 2^32, the addition may wrap around
+        values = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % _PRIME
+        return (values & _MAX_HASH).min(axis=1).astype(np.uint32)
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of the sets behind two signatures."""
+
+    return float(np.mean(sig_a == sig_b))
+
+
+def lsh_params(threshold, num_perm):
+    """Number of (bands, rows per band) whose S-curve best separates pairs below and above `threshold`.
+
+    Two signatures become candidates if all rows of any band are equal, which happens with probability
+    1 - (1 - s^rows)^bands at Jaccard similarity s. Minimizes the weighted areas of false positives and false
+    negatives.
+    """
+
+    s = np.linspace(0, 1, 1001)
+    best, best_error = None, None
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        p = 1 - (1 - s ** rows) ** bands
+        false_positives = p[s < threshold].sum()
+        false_negatives = (1 - p[s >= threshold]).sum()
+        error = (1 - FALSE_NEGATIVE_WEIGHT) * false_positives + FALSE_NEGATIVE_WEIGHT * false_negatives
+        if best_error is None or error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+class LSHIndex:
+    """Banded locality-sensitive hashing of MinHash signatures, to find candidate near-duplicates without
+    comparing every pair."""
+
+    def __init__(self, threshold, num_perm=DEFAULT_NUM_PERM):
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.buckets = [{} for _ in range(self.bands)]
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def insert(self, item, signature):
+        for band, key in self._band_keys(signature):
+            self.buckets[band].setdefault(key, []).append(item)
+
+    def query(self, signature):
+        """Items sharing at least one band with the signature, in order of insertion."""
+
+        candidates = {}
+        for band, key in self._band_keys(signature):
+            for item in self.buckets[band].get(key, []):
+                candidates[item] = None
+        return list(candidates)
+
+
+class NearDuplicates:
+    """Online near-duplicate filter: a text is a duplicate if its estimated Jaccard similarity to a text seen
+    before is at least `threshold`, otherwise it is kept and later texts are compared against it.
+
+    The first occurrence of every cluster is kept, and each text costs about the same whatever the number seen.
+    Texts without any word (e.g. empty) are kept without being compared, they would all match each other.
+    """
+
+    def __init__(self, threshold, num_perm=DEFAULT_NUM_PERM, seed=0):
+        if not 0 < threshold <= 1:
+            raise ValueError(f'Jaccard threshold should be in (0, 1], got {threshold}')
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, seed)
+        self.index = LSHIndex(threshold, num_perm)
+        self.keys = []
+        self.signatures = []
+
+    def check(self, key, text):
+        """Return (key, similarity) of the kept text that `text` duplicates, or None after keeping it as `key`."""
+
+        if not re.search(r'\w', text):
+            return None
+
+        signature = self.hasher.signature(text)
+        best = None
+        for item in self.index.query(signature):
+            sim = similarity(signature, self.signatures[item])
+            if sim >= self.threshold and (best is None or sim > best[1]):
+                best = (self.keys[item], sim)
+        if best is not None:
+            return best
+
+        self.index.insert(len(self.keys), signature)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        return None
+
+
+def _jaccard(a, b):
+    a, b = shingles(a), shingles(b)
+    return len(a & b) / len(a | b)
+
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+
+    def random_text(n):
+        return ' '.join(f'w{i}' for i in rng.integers(5000, size=n))
+
+    def edit(text, fraction):
+        words = text.split()
+        for i in rng.choice(len(words), size=int(fraction * len(words)), replace=False):
+            words[i] = f'w{rng.integers(5000)}'
+        return ' '.join(words)
+
+    # Unit test: Signature similarity estimates the Jaccard similarity of the shingles
+    hasher = MinHasher(num_perm=256)
+    text = random_text(200)
+    for fraction in [0, 0.05, 0.2, 0.5]:
+        other = edit(text, fraction)
+        assert abs(similarity(hasher.signature(text), hasher.signature(other)) - _jaccard(text, other)) < 0.1
+    assert shingles('Hello, World!') == {'hello world'}
+
+    # Unit test: Banding puts the S-curve around the threshold
+    bands, rows = lsh_params(0.8, 128)
+    assert bands * rows <= 128 and 1 - (1 - 0.8 ** rows) ** bands > 0.8 > 1 - (1 - 0.6 ** rows) ** bands
+
+    # Unit test: Edited copies are dropped as duplicates of the first occurrence, unrelated texts are kept
+    dedup = NearDuplicates(0.7)
+    originals = [random_text(100) for _ in range(50)]
+    assert all(dedup.check(i, text) is None for i, text in enumerate(originals))
+    assert [dedup.check(f'copy{i}', edit(text, 0.01))[0] for i, text in enumerate(originals)] == list(range(50))
+    assert dedup.check('new', random_text(100)) is None
+    assert dedup.check('same', originals[3]) == (3, 1.0)
+    for key, text in [('empty', ''), ('blank', ' '), ('punctuation', '?!'), ('empty again', '')]:
+        assert dedup.check(key, text) is None
+
+    # Benchmark: LSH against comparing every text with all kept ones, on texts of which a fifth are edited copies
+    texts = [random_text(150) for _ in range(4000)]
+    texts += [edit(texts[i], 0.02) for i in rng.choice(len(texts), size=1000, replace=False)]
+    start = time.perf_counter()
+    dedup = NearDuplicates(0.8)
+    dropped = sum(dedup.check(i, text) is not None for i, text in enumerate(texts))
+    print(f'lsh: {dropped} of {len(texts)} dropped, {(time.perf_counter() - start) * 1000:.0f} ms')
+    start = time.perf_counter()
+    kept = np.empty((0, DEFAULT_NUM_PERM), dtype=np.uint32)
+    dropped = 0
+    for text in texts:
+        signature = dedup.hasher.signature(text)
+        if len(kept) and (kept == signature).mean(axis=1).max() >= 0.8:
+            dropped += 1
+        else:
+            kept = np.vstack([kept, signature])
+    print(f'all pairs: {dropped} of {len(texts)} dropped, {(time.perf_counter() - start) * 1000:.0f} ms')
+
+    print('All unit tests passed.')
@@ -1,15 +1,31 @@
 import os
 import re
+import glob
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-import requests
 import pandas as pd
 
-from common import setup_dir, read_spec, validate_spec, ArgsWrapper
-from adapters import gdrive, piazza
+from common import DATA_DIR, setup_dir, read_spec, validate_spec, ArgsWrapper
+from common import Manifest, blob_path, put_blob, link_blob, prune_blobs
+from cache import make_key
+from adapters import gdrive, piazza, session
+from adapters.throttle import HostThrottle, host_of
 
 
-def get_material(args):
+DEFAULT_JOBS = 8
+
+
+def get_material(args, validators=None):
+    """Fetch a material, returns (content, extension, validators).
+
+    If `validators` (etag/last_modified of the local copy) are given, a conditional request is sent,
+    and content is None when the server reports the material as unchanged.
+    """
+
+    dlflags = dict(getattr(args, 'dlflags', {}))
     if match := re.match(r'https://docs.google.com/(\w+)/d/([-_a-z0-9]+)/', args.uri, re.IGNORECASE):
         file_type = match.group(1)
         if file_type == 'document':
@@ -19,43 +35,225 @@ def get_material(args):
             mime_type = 'application/pdf'
             extn = '.pdf'
         file_id = match.group(2)
-        text = gdrive.download(file_id, mime_type, **getattr(args, 'dlflags', {}))
+        # Drive exports are generated on the fly, there are no validators to check against
+        text = gdrive.download(file_id, mime_type, **dlflags)
+        return text, extn, {}
+
+    headers = dict(dlflags.pop('headers', {}))
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    resp = session.get(args.uri, headers=headers, **dlflags)
+    if resp.status_code == 304:
+        return None, validators['extn'], validators
+    resp.raise_for_status()
+    if 'text/html' in resp.headers['content-type']:
+        extn = '.html'
+    elif 'application/pdf' in resp.headers['content-type']:
+        extn = '.pdf'
     else:
-        resp = requests.get(args.uri, **getattr(args, 'dlflags', {}))
-        resp.raise_for_status()
-        if 'text/html' in resp.headers['content-type']:
-            extn = '.html'
-        elif 'application/pdf' in resp.headers['content-type']:
-            extn = '.pdf'
-        else:
-            raise RuntimeError('Unknown URI type, it was neither Google Drive nor HTML!')
-        text = resp.content
+        raise RuntimeError('Unknown URI type, it was neither Google Drive nor HTML!')
+    text = resp.content
+
+    return text, extn, {'etag': resp.headers.get('etag'), 'last_modified': resp.headers.get('last-modified')}
+
+
+class Fetched:
+    """Materials downloaded during a run, keyed by URI and download flags, shared by the rows of all courses.
+
+    A URI linked from several rows or courses is then only downloaded once.
+    """
 
-    return text, extn
+    def __init__(self):
+        self.results = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+def _has_blob(entry):
+    return os.path.isfile(blob_path(entry['sha256'], entry['extn']))
+
+
+def _find_by_uri(uri):
+    """Manifest entry of the same URI in any course, if its blob is stored, to revalidate instead of downloading."""
+
+    for path in glob.glob(os.path.join(DATA_DIR, 'manifests', '*', 'materials.json')):
+        with open(path) as fp:
+            for entry in json.load(fp).values():
+                if entry['uri'] == uri and _has_blob(entry):
+                    return entry
+    return None
+
+
+def _fetch(args, entry):
+    """Download a material into the blob store, returns (sha256, size, extension, validators).
+
+    `entry` is the manifest entry to revalidate, if any. Without one, an entry of the same URI in another course
+    is revalidated instead, so identical materials of several courses are only downloaded once.
+    """
+
+    known = entry
+    if known is None and not getattr(args, 'force', False):
+        known = _find_by_uri(args.uri)
+    text, extn, validators = get_material(args, validators=known)
+    if text is None:
+        return known['sha256'], known['size'], extn, validators
+    return put_blob(text, extn), len(text), extn, validators
 
 
 def download_material(args):
+    """Download a material, unless the manifest shows the local copy is up-to-date.
+
+    The file is stored once in the blob store, and .cache/materials/<course>/<name>.<extn> is a link to it.
+    Returns True if the local copy changed.
+    """
+
     outdir = setup_dir('materials', args.course)
-    text, extn = get_material(args)
-    with open(os.path.join(outdir, args.name + extn), 'wb') as fp:
-        fp.write(text)
+    manifest = getattr(args, 'manifest', None) or Manifest(args.course)
+    fetched = getattr(args, 'fetched', None) or Fetched()
+
+    entry = manifest.get(args.name)
+    if entry is None or getattr(args, 'force', False) or entry['uri'] != args.uri:
+        entry = None
+    elif not _has_blob(entry):
+        # Downloaded before the blob store (or its blob was pruned), keep the local copy if it is intact
+        local = os.path.join(outdir, args.name + entry['extn'])
+        if not os.path.isfile(local):
+            entry = None
+        else:
+            with open(local, 'rb') as fp:
+                if put_blob(fp.read(), entry['extn']) != entry['sha256']:
+                    entry = None
+
+    key = make_key(args.uri, getattr(args, 'dlflags', {}))
+    with fetched.lock(key):
+        if key not in fetched.results:
+            fetched.results[key] = _fetch(args, entry)
+        digest, size, extn, validators = fetched.results[key]
+
+    path = os.path.join(outdir, args.name + extn)
+    changed = entry is None or entry['sha256'] != digest or entry['extn'] != extn
+    link_blob(digest, extn, path)
+    if entry is not None and entry['extn'] != extn:
+        # Material changed type, drop the stale copy so it is not picked up by the parser
+        stale = os.path.join(outdir, args.name + entry['extn'])
+        if os.path.isfile(stale):
+            os.remove(stale)
+    manifest.update(args.name, {
+        'uri': args.uri,
+        'extn': extn,
+        'etag': validators.get('etag'),
+        'last_modified': validators.get('last_modified'),
+        'sha256': digest,
+        'size': size,
+        'fetched_at': datetime.now(timezone.utc).isoformat(timespec='seconds')
+    })
+
+    if getattr(args, 'manifest', None) is None:
+        manifest.save()
+    return changed
 
 
-def get_forum(args):
+def get_forum(args, **kwargs):
     if m := re.match(r'https://piazza\.com/class/(\w+)$', args.uri, re.IGNORECASE):
         class_id = m.group(1)
         handle = piazza.login()
-        posts = piazza.download_posts(handle, class_id, **getattr(args, 'dlflags', {}))
-        return posts
+        return piazza.iter_posts(handle, class_id, **getattr(args, 'dlflags', {}), **kwargs)
     else:
         raise RuntimeError('Unknown URI type, only Piazza links are supported currently.')
 
 
+def _truncate_partial_line(path):
+    """Drop a partially written last line, left behind if a download was killed midway."""
+
+    with open(path, 'rb+') as fp:
+        pos = fp.seek(0, os.SEEK_END)
+        while pos > 0:
+            step = min(4096, pos)
+            pos -= step
+            fp.seek(pos)
+            if (i := fp.read(step).rfind(b'\n')) != -1:
+                fp.truncate(pos + i + 1)
+                return
+        fp.truncate(0)
+
+
+def _merge_forum(path, partial, checkpoint):
+    """Replace the local copy with its unchanged posts plus the newly downloaded ones."""
+
+    modified = dict(checkpoint.feed)
+
+    # A resumed download may have fetched a post twice, keep the last copy
+    latest = {}
+    with open(partial) as fp:
+        for i, line in enumerate(fp):
+            latest[json.loads(line)['id']] = i
+
+    posts = {}
+    merged = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+    with open(merged, 'w') as out:
+        if os.path.isfile(path):
+            with open(path) as fp:
+                for line in fp:
+                    post_id = json.loads(line)['id']
+                    # Posts no longer in the feed were deleted, or are outside the requested folders
+                    if post_id in modified and post_id not in latest:
+                        out.write(line)
+                        posts[post_id] = modified[post_id]
+        with open(partial) as fp:
+            for i, line in enumerate(fp):
+                post_id = json.loads(line)['id']
+                if latest[post_id] == i:
+                    out.write(line)
+                    posts[post_id] = modified[post_id]
+
+    os.replace(merged, path)
+    os.remove(partial)
+    checkpoint.finish(posts)
+
+
 def download_forum(args):
+    """Download a forum as JSON Lines, writing each post as soon as it arrives.
+
+    Only posts that are new or were modified since the last download are fetched. Progress is checkpointed,
+    so an interrupted download resumes where it left off.
+    """
+
     outdir = setup_dir('forums', args.course)
-    posts = get_forum(args)
-    with open(os.path.join(outdir, args.name + '.json'), 'w') as fp:
-        json.dump(posts, fp, indent=4)
+    path = os.path.join(outdir, args.name + '.jsonl')
+    # Hidden while incomplete, so that it is not picked up by the parser
+    partial = os.path.join(outdir, f'.{args.name}.jsonl.part')
+    checkpoint = piazza.Checkpoint(os.path.join(setup_dir('checkpoints', args.course), f'{args.name}.json'))
+
+    if getattr(args, 'force', False):
+        checkpoint.posts = {}
+        checkpoint.feed = None
+    elif not os.path.isfile(path):
+        checkpoint.posts = {}
+    if checkpoint.in_progress and os.path.isfile(partial):
+        _truncate_partial_line(partial)
+        mode = 'a'
+    else:
+        checkpoint.feed = None
+        mode = 'w'
+
+    with open(partial, mode) as fp:
+        for post in get_forum(args, known=checkpoint.posts, checkpoint=checkpoint):
+            fp.write(json.dumps(post) + '\n')
+            # Make sure the post is on disk before the checkpoint moves past it
+            fp.flush()
+    _merge_forum(path, partial, checkpoint)
+
+    legacy = os.path.join(outdir, args.name + '.json')
+    if os.path.isfile(legacy):
+        os.remove(legacy)
 
 
 def download_bulk(args):
@@ -70,23 +268,49 @@ def download_bulk(args):
     if validate_spec(df) == False:
         return
 
-    suc = 0
-    for _, row in df.iterrows():
+    jobs = getattr(args, 'jobs', DEFAULT_JOBS)
+    session.configure(pool_size=max(jobs, session.DEFAULT_POOL_SIZE))
+    throttle = HostThrottle()
+    manifest = Manifest(course, collection) if collection == 'materials' else None
+    fetched = Fetched()
+    force = getattr(args, 'force', False)
+
+    def download_row(row):
+        if 'dlflags' in row and not pd.isnull(row['dlflags']):
+            dlflags = json.loads(row['dlflags'])
+        else:
+            dlflags = {}
+        with throttle.limit(host_of(row['uri'])):
+            return download_fn(ArgsWrapper(course=course, name=row['name'], uri=row['uri'], dlflags=dlflags,
+                                           manifest=manifest, fetched=fetched, force=force))
+
+    rows = [row for _, row in df.iterrows()]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(download_row, row) for row in rows]
+
+        # Report in spec order, regardless of which download finishes first
+        suc = 0
         try:
-            if 'dlflags' in row and not pd.isnull(row['dlflags']):
-                dlflags = json.loads(row['dlflags'])
-            else:
-                dlflags = {}
-            download_fn(ArgsWrapper(course=course, name=row['name'], uri=row['uri'], dlflags=dlflags))
-            print(f'Completed: {row["name"]}: {row["uri"]}')
-            suc += 1
-        except Exception as e:
-            print(f'Failed: {row["name"]}: {row["uri"]}')
-            print(f'>', e)
+            for row, future in zip(rows, futures):
+                try:
+                    changed = future.result()
+                    note = ' (unchanged)' if changed == False else ''
+                    print(f'Completed: {row["name"]}: {row["uri"]}{note}')
+                    suc += 1
+                except Exception as e:
+                    print(f'Failed: {row["name"]}: {row["uri"]}')
+                    print(f'>', e)
+        finally:
+            if manifest is not None:
+                manifest.save()
 
     print(f'\nCompleted {suc}/{len(df)} successfully.')
 
 
+def prune_materials(args):
+    print(f'Removed {prune_blobs()} unused blobs.')
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -97,17 +321,24 @@ if __name__ == '__main__':
     m_parser.add_argument('course', help='course to which the material belongs')
     m_parser.add_argument('name', help='name of the document to save with')
     m_parser.add_argument('uri', help='document link on HTTP')
+    m_parser.add_argument('--force', action='store_true', help='download even if the local copy is up-to-date')
     m_parser.set_defaults(func=download_material)
 
     f_parser = subparsers.add_parser('forum')
     f_parser.add_argument('course', help='course to which the forum belongs')
     f_parser.add_argument('name', help='name of the document to save with')
     f_parser.add_argument('uri', help='link to forums (Piazza class)')
+    f_parser.add_argument('--force', action='store_true', help='download all posts, even if the local copy is up-to-date')
     f_parser.set_defaults(func=download_forum)
 
     b_parser = subparsers.add_parser('bulk')
     b_parser.add_argument('spec_file', help='file named <course>.<collection>.csv, containing name, links, etc.')
+    b_parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS, help='number of downloads to run concurrently')
+    b_parser.add_argument('--force', action='store_true', help='download even if the local copies are up-to-date')
     b_parser.set_defaults(func=download_bulk)
 
+    p_parser = subparsers.add_parser('prune')
+    p_parser.set_defaults(func=prune_materials)
+
     args = parser.parse_args()
     args.func(args)
@@ -0,0 +1,128 @@
+import os
+import glob
+import hashlib
+
+import numpy as np
+
+from common import DATA_DIR
+
+
+# Shards are merged into one once there are more than this many
+MAX_SHARDS = 32
+
+
+def sentence_key(sentence):
+    return hashlib.blake2b(sentence.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class EmbeddingStore:
+    """Append-only store of sentence embeddings under .cache/embeddings/<model_id>/.
+
+    Each batch of new embeddings is written as a float32 shard-<n>.npy, with the hashes of its sentences in
+    shard-<n>.keys. Shards are memory-mapped, so only the rows that are looked up are read from disk.
+    """
+
+    def __init__(self, model_id, dim):
+        self.root = os.path.join(DATA_DIR, 'embeddings', model_id)
+        os.makedirs(self.root, exist_ok=True)
+        self.dim = dim
+        self.shards = []
+        self.index = {}  # Sentence key -> (shard, row)
+        self._load()
+
+    def _load(self):
+        self.shards = []
+        self.index = {}
+        # The keys file is written last, so shards without one are incomplete and ignored
+        for keys_path in sorted(glob.glob(os.path.join(self.root, 'shard-*.keys'))):
+            vectors = np.load(keys_path[:-len('.keys')] + '.npy', mmap_mode='r')
+            with open(keys_path) as fp:
+                keys = fp.read().split()
+            shard = len(self.shards)
+            self.shards.append(vectors)
+            for row, key in enumerate(keys):
+                self.index[key] = (shard, row)
+
+    def _write_shard(self, name, keys, vectors):
+        path = os.path.join(self.root, name)
+        with open(f'{path}.npy.tmp', 'wb') as fp:
+            np.save(fp, np.asarray(vectors, dtype=np.float32))
+        os.replace(f'{path}.npy.tmp', f'{path}.npy')
+        with open(f'{path}.keys.tmp', 'w') as fp:
+            fp.write('\n'.join(keys))
+        os.replace(f'{path}.keys.tmp', f'{path}.keys')
+
+    def _next_shard_name(self):
+        numbers = [int(os.path.basename(p)[len('shard-'):-len('.keys')])
+                   for p in glob.glob(os.path.join(self.root, 'shard-*.keys'))]
+        return f'shard-{max(numbers, default=-1) + 1:06d}'
+
+    def add(self, sentences, vectors):
+        keys = [sentence_key(s) for s in sentences]
+        self._write_shard(self._next_shard_name(), keys, vectors)
+        self._load()
+        if len(self.shards) > MAX_SHARDS:
+            self.compact()
+
+    def compact(self):
+        """Merge all shards into a single one."""
+
+        old = glob.glob(os.path.join(self.root, 'shard-*'))
+        keys = list(self.index)
+        vectors = self._gather(keys)
+        name = self._next_shard_name()
+        self._write_shard(name, keys, vectors)
+        self.shards = []  # Release the memory maps before removing their files
+        for path in old:
+            os.remove(path)
+        self._load()
+
+    def _gather(self, keys):
+        matrix = np.empty((len(keys), self.dim), dtype=np.float32)
+        by_shard = {}
+        for i, key in enumerate(keys):
+            shard, row = self.index[key]
+            by_shard.setdefault(shard, ([], []))
+            by_shard[shard][0].append(i)
+            by_shard[shard][1].append(row)
+        for shard, (positions, rows) in by_shard.items():
+            matrix[positions] = self.shards[shard][rows]
+        return matrix
+
+    def lookup(self, sentences, embed_fn):
+        """Embeddings of `sentences` as a matrix, only calling `embed_fn` on sentences not stored yet."""
+
+        keys = [sentence_key(s) for s in sentences]
+        missing = {key: s for key, s in zip(keys, sentences) if key not in self.index}
+        if missing:
+            self.add(list(missing.values()), embed_fn(list(missing.values())))
+        return self._gather(keys)
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    DATA_DIR = tempfile.mkdtemp()
+    calls = []
+
+    def embed(sentences):
+        calls.append(len(sentences))
+        return np.array([[len(s), s.count('a')] for s in sentences], dtype=np.float32)
+
+    # Unit test: Only new sentences are embedded, and results survive a reload
+    store = EmbeddingStore('playground', 2)
+    assert store.lookup(['a', 'bb', 'a'], embed).tolist() == [[1, 1], [2, 0], [1, 1]]
+    assert store.lookup(['bb', 'aaa'], embed).tolist() == [[2, 0], [3, 3]]
+    assert calls == [2, 1]
+    store = EmbeddingStore('playground', 2)
+    assert store.lookup(['aaa', 'a'], embed).tolist() == [[3, 3], [1, 1]]
+    assert calls == [2, 1]
+
+    # Unit test: Compaction keeps every embedding
+    store.compact()
+    assert len(store.shards) == 1
+    assert store.lookup(['a', 'bb', 'aaa'], embed).tolist() == [[1, 1], [2, 0], [3, 3]]
+
+    shutil.rmtree(DATA_DIR)
+    print('All unit tests passed.')
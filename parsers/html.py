@@ -1,7 +1,10 @@
 from dataclasses import dataclass, field
+from functools import lru_cache
+from html.entities import html5
+from html.parser import HTMLParser
 import re
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 
 
 # To capture code, add the following: |pre|code
@@ -9,6 +12,13 @@ VALID_TAGS = re.compile(r'^(?:h\d|p|span|ul|ol|table)$')
 
 DOCUMENT_PARTITION_LENGTH = 100
 
+# Any tree builder supported by BeautifulSoup, e.g. 'lxml' is much faster (requires the lxml package).
+# Output is only guaranteed to match the default backend for well-formed HTML.
+HTML_BACKEND = 'html.parser'
+
+# Bump whenever a change affects the extracted output, this invalidates cached parses
+PARSER_VERSION = 1
+
 
 @dataclass
 class Section:
@@ -65,8 +75,19 @@ def _get_root(soup):
 def _flatten_list(root):
     """ Annotate list items with support for nesting."""
 
-    for item in root.find_all('li'):
-        level = len(item.find_parents(['ul', 'ol']))
+    # Track the list depth while walking down, instead of counting the parents of every item
+    items = []
+    stack = [(root, 1)]
+    while stack:
+        tag, level = stack.pop()
+        for child in tag.children:
+            if isinstance(child, Tag):
+                child_level = level + 1 if child.name in {'ul', 'ol'} else level
+                if child.name == 'li':
+                    items.append((child, child_level))
+                stack.append((child, child_level))
+
+    for item, level in items:
         item.insert(0, f' {"•" * level} ')
 
     text = ''.join(root.strings)
@@ -92,6 +113,32 @@ def _standardize_tag(tag):
         return 'plain'
 
 
+def _most_ancestral_tags(root):
+    """Find tags matching VALID_TAGS whose text is not already captured by some ancestor, in document order.
+
+    Done in a single walk that does not descend into captured tags, instead of checking the parents of every tag.
+    """
+
+    if VALID_TAGS.search(root.name) or root.find_parent(VALID_TAGS):
+        # Everything under the root is already inside a captured tag
+        return []
+
+    tags = []
+    stack = [iter(root.children)]
+    while stack:
+        for child in stack[-1]:
+            if not isinstance(child, Tag):
+                continue
+            if VALID_TAGS.search(child.name):
+                tags.append(child)
+            else:
+                stack.append(iter(child.children))
+                break
+        else:
+            stack.pop()
+    return tags
+
+
 def embed_hierarchy(content):
     """Convert a flat list of headers and paragraphs into a tree of sections."""
 
@@ -157,22 +204,17 @@ def partition_docs(node, threshold=DOCUMENT_PARTITION_LENGTH, prefix=[]):
     return doc
 
 
-def extract_text(path, **partition_args) -> list[dict]:
+def extract_text(path, backend=HTML_BACKEND, **partition_args) -> list[dict]:
     """Take a file path as input, and return a list of text with headings."""
 
     with open(path, 'r', encoding='utf-8') as fp:
         html = fp.read()
 
-    soup = BeautifulSoup(html, features='html.parser')
+    soup = BeautifulSoup(html, features=backend)
     root = _get_root(soup)
 
-    def most_ancestral_tag(tag):
-        name_valid = VALID_TAGS.search(tag.name) is not None
-        parent_valid = tag.find_parent(VALID_TAGS) is None  # Ensures text is not already captured by some ancestor
-        return name_valid and parent_valid
-
     results = []
-    for tag in root.find_all(most_ancestral_tag):
+    for tag in _most_ancestral_tags(root):
         if tag.name in {'ul', 'ol'}:
             text = _flatten_list(tag)
         elif tag.name == 'table':
@@ -198,6 +240,111 @@ def extract_text_basic(html):
     return text
 
 
+class _FragmentTextParser(HTMLParser):
+    """Collect the same strings as BeautifulSoup's `stripped_strings` (html.parser backend), without building a tree.
+
+    Mirrors how BeautifulSoup splits text into strings at markup events, decodes character references, closes
+    void elements, and skips text inside script, style, template and ruby annotation tags.
+    """
+
+    SKIPPED_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+    VOID_TAGS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+                 'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+                 'spacer', 'track', 'wbr'}
+    ENTITIES = {name.rstrip(';'): char for name, char in html5.items()}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.strings = []
+        self._buffer = []
+        self._open_tags = []
+        self._closed_void_tags = []
+        self._skipping = 0
+
+    def _flush(self):
+        if self._buffer:
+            text = ''.join(self._buffer).strip()
+            if text and not self._skipping:
+                self.strings.append(text)
+            self._buffer = []
+
+    def handle_starttag(self, tag, attrs, close_void=True):
+        self._flush()
+        self._open_tags.append(tag)
+        self._skipping += tag in self.SKIPPED_TAGS
+        if close_void and tag in self.VOID_TAGS:
+            self.handle_endtag(tag, check_closed=False)
+            # An explicit end tag may still follow, which should be ignored
+            self._closed_void_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, close_void=False)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag, check_closed=True):
+        if check_closed and tag in self._closed_void_tags:
+            self._closed_void_tags.remove(tag)
+            return
+        self._flush()
+        if tag in self._open_tags:
+            # Implicitly close any tags left open inside it
+            while (name := self._open_tags.pop()) != tag:
+                self._skipping -= name in self.SKIPPED_TAGS
+            self._skipping -= tag in self.SKIPPED_TAGS
+
+    def handle_data(self, data):
+        self._buffer.append(data)
+
+    def handle_charref(self, name):
+        code = int(name.lstrip('xX'), 16) if name[0] in 'xX' else int(name)
+        data = None
+        if code < 256:
+            # Numeric references are often meant as Windows-1252, e.g. &#147;
+            try:
+                data = bytes([code]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(code)
+            except (ValueError, OverflowError):
+                pass
+        self._buffer.append(data or '\N{REPLACEMENT CHARACTER}')
+
+    def handle_entityref(self, name):
+        self._buffer.append(self.ENTITIES.get(name, f'&{name}'))
+
+    def handle_comment(self, data):
+        self._flush()
+
+    def handle_decl(self, decl):
+        self._flush()
+
+    def handle_pi(self, data):
+        self._flush()
+
+    def unknown_decl(self, data):
+        self._flush()
+        if data.upper().startswith('CDATA['):
+            # CDATA is kept even inside skipped tags
+            if text := data[len('CDATA['):].strip():
+                self.strings.append(text)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+@lru_cache(maxsize=4096)
+def extract_text_fragment(html):
+    """Fast equivalent of `extract_text_basic` for small HTML fragments (e.g. forum posts)."""
+
+    parser = _FragmentTextParser()
+    parser.feed(html)
+    parser.close()
+    return ' '.join(' '.join(parser.strings).split())
+
+
 if __name__ == '__main__':
     with open('playground.html', 'w') as fp:
         fp.write("""
@@ -224,4 +371,7 @@ if __name__ == '__main__':
     text = extract_text_basic('<p>\nHello!\n<b> How are you doing? </b>\n</p>')
     assert text == 'Hello! How are you doing?'
 
+    text = extract_text_fragment('<p>\nHello!\n<b> How are you doing? </b>\n</p><script>var x;</script>')
+    assert text == 'Hello! How are you doing?'
+
     print('All unit tests passed.')
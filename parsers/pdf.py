@@ -1,22 +1,163 @@
 import os
-from io import StringIO 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
-from pickletools import OpcodeInfo
+from pdfminer.layout import LAParams, LTTextContainer
+from pdfminer.pdfpage import PDFPage
 
-def extract_text(path, *args, **kwargs) -> list[dict]:
-    """Take a file path as input, and return a list of text with headings."""
+# Bump whenever a change affects the extracted output, this invalidates cached parses
+PARSER_VERSION = 2
+
+# Pages shorter than this (in characters) are merged into the previous section when splitting
+SECTION_PARTITION_LENGTH = 100
+
+PAGES_PER_CHUNK = 8
+
+# Chunks laid out ahead of the one being yielded, per worker, which bounds the pages held in memory
+CHUNKS_AHEAD_PER_JOB = 2
+
+# pflags of `iter_pages`, `extract_text` accepts `split` and, when splitting, `threshold` too
+PAGE_ARGS = ('pages', 'laparams', 'jobs')
+
+# Stands for the file name in the titles of cached parses, so that identical files under other names share one
+TITLE_PLACEHOLDER = '\x00'
+
+
+def _select_pages(path, pages):
+    """Convert an inclusive, 1-indexed [first, last] page range into 0-indexed page numbers."""
+
+    with open(path, 'rb') as fp:
+        count = sum(1 for _ in PDFPage.get_pages(fp))
+    first, last = pages if pages else (1, count)
+    return list(range(max(first, 1) - 1, min(last, count)))
+
+
+def _extract_pages(path, page_numbers, laparams):
+    """Yield the paragraphs of every page, one page at a time."""
+
+    for page_layout in extract_pages(path, page_numbers=page_numbers, laparams=LAParams(**(laparams or {}))):
+        yield [clean_paragraph(element.get_text()) for element in page_layout if isinstance(element, LTTextContainer)]
+
+
+def _extract_chunk(path, page_numbers, laparams):
+    return list(_extract_pages(path, page_numbers, laparams))
+
+
+def iter_pages(path, pages=None, laparams=None, jobs=1):
+    """Yield (page number, paragraphs) for every page, in order.
+
+    `pages` is an inclusive, 1-indexed [first, last] range, and `laparams` are keyword arguments of pdfminer's
+    LAParams. With `jobs` > 1, chunks of pages are laid out by worker processes, a few chunks ahead of the pages
+    being yielded.
+    """
+
+    if jobs <= 1 and not pages:
+        for i, paragraphs in enumerate(_extract_pages(path, None, laparams)):
+            yield i + 1, paragraphs
+        return
+
+    page_numbers = _select_pages(path, pages)
+    if jobs <= 1:
+        for i, paragraphs in zip(page_numbers, _extract_pages(path, page_numbers, laparams)):
+            yield i + 1, paragraphs
+        return
+
+    chunks = iter(page_numbers[i:i + PAGES_PER_CHUNK] for i in range(0, len(page_numbers), PAGES_PER_CHUNK))
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    pending = deque()
+
+    def submit_next():
+        chunk = next(chunks, None)
+        if chunk is not None:
+            pending.append((chunk, pool.submit(_extract_chunk, path, chunk, laparams)))
+
+    try:
+        for _ in range(jobs * CHUNKS_AHEAD_PER_JOB):
+            submit_next()
+        while pending:
+            chunk, future = pending.popleft()
+            submit_next()
+            for i, paragraphs in zip(chunk, future.result()):
+                yield i + 1, paragraphs
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def iter_sections(path, split='page', threshold=SECTION_PARTITION_LENGTH, title=None, **page_args):
+    """Yield a section per page (split='page') or per slide (split='slide') as soon as it is complete.
+
+    Slides are titled with their first paragraph, and consecutive pages with the same heading are merged.
+    Pages shorter than `threshold` characters are merged into the previous section.
+    """
+
+    if split not in {'page', 'slide'}:
+        raise ValueError(f'Unknown split "{split}", should be one of: page, slide')
+
+    title = get_title(path) if title is None else title
+    seen = set()
+    section = None
+    for number, paragraphs in iter_pages(path, **page_args):
+        if not any(paragraphs):
+            continue
+
+        if split == 'slide':
+            heading, paragraphs = paragraphs[0], paragraphs[1:]
+            if section is not None and section['heading'] == heading:
+                section['contents'].extend({'tag': 'plain', 'text': text} for text in paragraphs)
+                continue
+            page_title = f'{title}: {heading}' if heading not in seen else f'{title}: {heading} (page {number})'
+            seen.add(heading)
+        else:
+            heading = None
+            page_title = f'{title}: page {number}'
+
+        contents = [{'tag': 'plain', 'text': text} for text in paragraphs]
+        if section is not None and sum(len(text) for text in paragraphs) < threshold:
+            if heading is not None:
+                section['contents'].append({'tag': 'plain', 'text': heading})
+            section['contents'].extend(contents)
+            continue
+
+        if section is not None:
+            yield {'title': section['title'], 'contents': section['contents']}
+        section = {'title': page_title, 'heading': heading, 'contents': contents}
+
+    if section is not None:
+        yield {'title': section['title'], 'contents': section['contents']}
+
+
+def extract_text(path, *args, split=None, title=None, **kwargs) -> list[dict]:
+    """Take a file path as input, and return a list of text with headings.
+
+    By default the whole PDF is a single document. Use `split` to get a document per page or slide instead.
+    Documents are titled after the file name, unless `title` is given.
+    """
+
+    allowed = PAGE_ARGS + (('threshold',) if split is not None else ())
+    unknown = [k for k in kwargs if k not in allowed]
+    if unknown:
+        raise ValueError(f'Unknown pflags {", ".join(unknown)}, should be among: split, {", ".join(allowed)}')
+
+    if split is not None:
+        return list(iter_sections(path, split=split, title=title, **kwargs))
 
     paragraph_text = []
-    for page_layout in extract_pages(path):
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                paragraph_text.append(clean_paragraph(element.get_text()))
+    for _, paragraphs in iter_pages(path, **kwargs):
+        paragraph_text.extend(paragraphs)
+
+    return to_json(get_title(path) if title is None else title, paragraph_text)
+
+
+def retitle(records, title):
+    """Records extracted with `title=TITLE_PLACEHOLDER`, titled `title` instead."""
+
+    return [{**record, 'title': title + record['title'][len(TITLE_PLACEHOLDER):]} for record in records]
+
+
+def get_title(path):
     title = os.path.split(path)[1]
     assert title.endswith('.pdf')
-    title = title[:-4]
-    
-    return to_json(title, paragraph_text) 
+    return title[:-4]
 
 
 def clean_paragraph(paragraph_text):
@@ -1,60 +1,143 @@
-from .html import extract_text_basic
+from .html import extract_text_fragment
 import json
 import re
 
+# Bump whenever a change affects the extracted output, this invalidates cached parses
+PARSER_VERSION = 5
+
+LINK_PATTERN = re.compile(r'@(\d+)')
+
 def get_question_tags(posts):
     question_numbers = []
     for post in posts:
         question_numbers.append(int(post.get("tag_num")))
     return question_numbers
 
-def trace_back_check(formatted_QA, rawQA):
+def _other_answer(field):
+    return "instructor_answer" if field == "student_answer" else "student_answer"
+
+
+ANSWER_FIELDS = ("student_answer", "instructor_answer")
+
+
+def _answer_links(post, field, index):
+    """Answers (tag_num, field) that the @N mentions of an answer link to, in order of mention.
+
+    None if the answer mentions nothing, and an empty list if none of its mentions link to a question.
+    """
+
+    mentions = dict.fromkeys(int(n) for n in LINK_PATTERN.findall(post[field]))  # Unique, in order of mention
+    if not mentions:
+        return None
+    links = []
+    for tag_num in mentions:
+        linked = index.get(tag_num)
+        if linked is not None:
+            # Prefer the same kind of answer in the linked post, fall back to the other one
+            links.append((tag_num, field if linked[field] != "" else _other_answer(field)))
+    return links
+
+
+def _resolve_component(component, links, index, resolved):
+    """Resolve the answers of a strongly connected component, once those it links to outside are resolved.
+
+    Answers of a cycle all resolve to the answers it leads out to, by (tag_num, field) then order of mention, and to
+    None if it leads nowhere. An answer that mentions nothing is kept as is.
+    """
+
+    if len(component) == 1 and links[component[0]] is None:
+        tag_num, field = component[0]
+        resolved[component[0]] = index[tag_num][field]
+        return
 
-    to_remove = []
-    question_tag_numbers = get_question_tags(formatted_QA)
+    members = set(component)
+    exits = dict.fromkeys(link for node in sorted(component) for link in links[node] if link not in members)
+    answers = [resolved[link] for link in exits if resolved[link]]
+    for node in component:
+        resolved[node] = " ".join(answers) if answers else None
+
+
+def _resolve_answers(index):
+    """Replace every @N mention in answers with the answer of the linked question, following chains of links.
+
+    Returns {(tag_num, field): answer}, see `_resolve_component`. Each strongly connected component of the links
+    is resolved once, in the order Tarjan's algorithm (here iterative) completes them, which is after every
+    component they link to. The result does not depend on the order of posts, and takes linear time.
+    """
+
+    links = {(tag_num, field): _answer_links(post, field, index) for tag_num, post in index.items()
+             for field in ANSWER_FIELDS}
+    resolved = {}
+    order, low = {}, {}
+    stack, on_stack = [], set()
+    for root in links:
+        if root in order:
+            continue
+        order[root] = low[root] = len(order)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(links[root] or []))]
+        while work:
+            node, targets = work[-1]
+            for target in targets:
+                if target not in order:
+                    order[target] = low[target] = len(order)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(links[target] or [])))
+                    break
+                if target in on_stack:
+                    low[node] = min(low[node], order[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == order[node]:
+                    component = []
+                    while not component or component[-1] != node:
+                        component.append(stack.pop())
+                        on_stack.discard(component[-1])
+                    _resolve_component(component, links, index, resolved)
+    return resolved
+
+
+def trace_back_check(formatted_QA):
+    """Resolve @N cross-references in answers, dropping posts whose links do not lead to any question."""
+
+    resolved = _resolve_answers({post["tag_num"]: post for post in formatted_QA})
+    drop_ids = set()
+    updates = []
     for post in formatted_QA:
-        student_answer = post.get("student_answer")         # the current post's student answer
-        instructor_answer = post.get("instructor_answer")   # the current post's instructor answer
-        if "@" in student_answer:                           # IF there is an @ symbol in the student's answer
-            index = student_answer.index("@")
-            if student_answer[index+1].isnumeric():         # and the next index is a number
-                link_val = re.search('\@(\d*)', student_answer)[1]  # get the number next to the @ sign
-                if int(link_val) in question_tag_numbers:                # IF the number is the num_tag to a question
-                    for post_sub in formatted_QA:                   # LOOP through the formmatted posts
-                        if post_sub.get("tag_num") == int(link_val):     # IF we find the right post
-                            if post_sub.get("student_answer") != "":# and IF that linked post has a student answer
-                                post["student_answer"] = post_sub.get("student_answer") # over write the dataset with the linked answer
-                            else:
-                                post["student_answer"] = post_sub.get("instructor_answer") # if there isn't a student answer in the linked post, rewrite with the instructor answer
-                else: # IF the linked post is NOT a question
-                    to_remove.append(post)
-        
-        
-        if "@" in instructor_answer:                           # IF there is an @ symbol in the student's answer
-            index = instructor_answer.index("@")
-            if instructor_answer[index+1].isnumeric():         # and the next index is a number
-                link_val = re.search('\@(\d*)', instructor_answer)[1]  # get the number next to the @ sign
-                if int(link_val) in question_tag_numbers:                # IF the number is the num_tag to a question
-                    for post_sub in formatted_QA:                   # LOOP through the formmatted posts
-                        if post_sub.get("tag_num") == int(link_val):     # IF we find the right post
-                            if post_sub.get("instructor_answer") != "":# and IF that linked post has a student answer
-                                post["instructor_answer"] = post_sub.get("instructor_answer") # over write the dataset with the linked answer
-                            else:
-                                post["instructor_answer"] = post_sub.get("student_answer") # if there isn't a student answer in the linked post, rewrite with the instructor answer
-                else: # IF the linked post is NOT a question
-                    to_remove.append(post)
-    for drop in to_remove:
-        if drop in formatted_QA:
-            formatted_QA.remove(drop)
-    return formatted_QA
+        for field in ANSWER_FIELDS:
+            answer = resolved[(post["tag_num"], field)]
+            if answer is None:
+                drop_ids.add(post["id"])
+            elif answer != post[field]:
+                updates.append((post, field, answer))
+
+    # Apply once everything is resolved, so that results do not depend on the order of posts
+    for post, field, answer in updates:
+        post[field] = answer
+    return [post for post in formatted_QA if post["id"] not in drop_ids]
+
+
+def iter_raw_posts(path):
+    """Yield raw posts one at a time from a JSON Lines dump (or a legacy JSON list)."""
+
+    with open(path) as fp:
+        if path.endswith('.jsonl'):
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(fp)
 
 
 def extract_question_posts(post_list):
-    questions = []
     for post in post_list:
         if (post.get("type") == "question") and ("unanswered" not in post.get("tags")):
-            questions.append(post)
-    return questions
+            yield post
 
 
 def get_answers(post):
@@ -90,8 +173,9 @@ def get_answerability(post):
     str_list_content = ["my grade", "waitlist", "stolen", "lost", "png", "jpeg", "howamidoing"]
     str_list_i_answer = ["private", "email me", "email us", "privately", "resolved"]
     
-    content_clean = re.sub(r'[^\w\s]', '', extract_text_basic(post.get("content")).lower())
-    i_answer_clean = re.sub(r'[^\w\s]', '', extract_text_basic(post.get("instructor_answer")).lower())
+    # Content and answers are already converted to plain text by extract_qa
+    content_clean = re.sub(r'[^\w\s]', '', post.get("content").lower())
+    i_answer_clean = re.sub(r'[^\w\s]', '', post.get("instructor_answer").lower())
     if any(ext in content_clean for ext in str_list_content) or any(ext in i_answer_clean for ext in str_list_i_answer):
         result = False
     else:
@@ -101,21 +185,17 @@ def get_answerability(post):
 
 def extract_qa(path, *args, **kwargs) -> list[dict]:
     """Take a file path as input, and return a list of question-answers."""
-    f1 = open(path)
-    raw_QA = json.load(f1)
-    f1.close()
-
-    answered_questions = extract_question_posts(raw_QA)
+    answered_questions = extract_question_posts(iter_raw_posts(path))
     formatted_QA = []
     for post in answered_questions:
         i_answer, i_thanks_count, s_answer, s_thanks_count = get_answers(post)
         post_dict = {"id": post.get("id"),
                      "tag_num": post.get("nr"),
                      "subject": get_subject(post),
-                     "content": extract_text_basic(get_question_content(post)),
-                     "student_answer": extract_text_basic(s_answer),
+                     "content": extract_text_fragment(get_question_content(post)),
+                     "student_answer": extract_text_fragment(s_answer),
                      "student_answer_thanks_count": s_thanks_count,
-                     "instructor_answer": extract_text_basic(i_answer),
+                     "instructor_answer": extract_text_fragment(i_answer),
                      "instructor_answer_thanks_count": i_thanks_count,
                      "folders": post.get("folders"),
                      "good_question_count": len(post.get("tag_good"))}
@@ -125,9 +205,41 @@ def extract_qa(path, *args, **kwargs) -> list[dict]:
             continue
         post_dict["is_answerable"] = get_answerability(post_dict)
         formatted_QA.append(post_dict)
-    final_QA = trace_back_check(formatted_QA, raw_QA)
+    final_QA = trace_back_check(formatted_QA)
     return final_QA
 
 
 if __name__ == '__main__':
-    print('Write any tests or debugging code here.')
+    def make_post(tag_num, student_answer, instructor_answer=''):
+        return {'id': f'id{tag_num}', 'tag_num': tag_num,
+                'student_answer': student_answer, 'instructor_answer': instructor_answer}
+
+    # Unit test: Links are resolved through chains, all mentions are used, and dead or cyclic links are dropped
+    posts = [
+        make_post(1, 'See @2'),
+        make_post(2, '@3'),
+        make_post(3, '', 'Use a dict.'),
+        make_post(4, 'Both @3 and @5'),
+        make_post(5, 'Try a set.'),
+        make_post(6, 'See @99'),
+        make_post(7, '@8'),
+        make_post(8, '@7'),
+    ]
+    pairs = trace_back_check(posts)
+    assert [p['tag_num'] for p in pairs] == [1, 2, 3, 4, 5]
+    assert pairs[0]['student_answer'] == 'Use a dict.'
+    assert pairs[3]['student_answer'] == 'Use a dict. Try a set.'
+
+    # Unit test: A post whose only link leads into a cycle with an answered exit is kept, whatever the order
+    for order in [[1, 2, 3], [2, 1, 3], [3, 2, 1]]:
+        texts = {1: '@2 @3', 2: '@1', 3: 'Real answer.'}
+        pairs = trace_back_check([make_post(n, texts[n]) for n in order])
+        assert {p['tag_num']: p['student_answer'] for p in pairs} == {n: 'Real answer.' for n in order}
+
+    # Unit test: A long, densely cross-linked cycle is resolved once as a whole, without recursing along it
+    n = 20000
+    posts = [make_post(i, f'@{i + 1} @{i - 1} @{(i * 7) % n}') for i in range(n)] + [make_post(n, 'Done.')]
+    pairs = trace_back_check(posts)
+    assert len(pairs) == n + 1 and all(p['student_answer'] == 'Done.' for p in pairs)
+
+    print('All unit tests passed.')
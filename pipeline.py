@@ -0,0 +1,354 @@
+import os
+import re
+import json
+import glob
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+import dlutil
+import putil
+import xutil
+from adapters import session
+from ann import INDEX_BACKENDS
+from adapters.throttle import HostThrottle, host_of
+from cache import make_key
+from common import DATA_DIR, read_spec, validate_spec, file_hash, write_atomic, material_files, ArgsWrapper, Manifest
+
+
+STATE_FILE = 'state.json'
+
+# Downloads are revalidated with the server (a conditional request) once they are older than this, in hours
+DEFAULT_MAX_AGE = 24
+
+DEFAULT_PARSE_JOBS = max(1, (os.cpu_count() or 2) - 1)
+
+
+class State:
+    """Fingerprints of the nodes completed by previous runs: node -> {key, outputs: {path: sha256}, at}.
+
+    A node is up-to-date if its key (a hash of its inputs) is unchanged and its outputs were not modified since.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(DATA_DIR, 'pipeline', STATE_FILE)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.nodes = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as fp:
+                self.nodes = json.load(fp)
+
+    def is_fresh(self, node, key, max_age=None):
+        entry = self.nodes.get(node)
+        if entry is None or entry['key'] != key:
+            return False
+        if max_age is not None and time.time() - entry['at'] > max_age:
+            return False
+        return all(os.path.isfile(path) and file_hash(path) == digest for path, digest in entry['outputs'].items())
+
+    def record(self, node, key, outputs):
+        self.nodes[node] = {
+            'key': key,
+            'outputs': {path: file_hash(path) for path in outputs},
+            'at': time.time()
+        }
+
+    def save(self):
+        write_atomic(self.path, json.dumps(self.nodes, indent=4, sort_keys=True).encode('utf-8'))
+
+
+def _row_flags(row, column):
+    if column in row and not pd.isnull(row[column]):
+        return json.loads(row[column])
+    return {}
+
+
+def load_tasks(spec_dir, course_pattern):
+    """One task per spec row, with the course, collection, name, uri and flags needed by every stage."""
+
+    tasks = []
+    for spec_file in sorted(glob.glob(os.path.join(spec_dir, '*.*.csv'))):
+        course, collection, df = read_spec(spec_file)
+        if re.search(course_pattern, course) is None:
+            continue
+        if collection not in {'materials', 'forums'}:
+            raise RuntimeError(f'Unknown collection in {spec_file}, should be one of: materials, forums')
+        if validate_spec(df) == False:
+            raise RuntimeError(f'Invalid spec: {spec_file}')
+        for _, row in df.iterrows():
+            tasks.append(ArgsWrapper(course=course, collection=collection, name=row['name'], uri=row['uri'],
+                                     dlflags=_row_flags(row, 'dlflags'), pflags=_row_flags(row, 'pflags'),
+                                     id=f'{course}/{collection}/{row["name"]}'))
+    return tasks
+
+
+def _downloaded_file(task, manifest=None):
+    """Path of the downloaded copy of a spec row, or None if there is none (or more than one)."""
+
+    if task.collection == 'materials':
+        paths = material_files(task.course, task.name, manifest)
+    else:
+        paths = glob.glob(os.path.join(DATA_DIR, 'forums', task.course, f'{glob.escape(task.name)}.*'))
+    return paths[0] if len(paths) == 1 else None
+
+
+def _parsed_file(task):
+    folder = 'documents' if task.collection == 'materials' else 'qa_pairs'
+    return os.path.join(DATA_DIR, folder, task.course, f'{task.name}.json')
+
+
+def _download_key(task):
+    return make_key(task.uri, task.dlflags)
+
+
+def _parse_key(task, path):
+    parser = 'piazza' if task.collection == 'forums' else os.path.splitext(path)[1][1:]
+    version = putil.PARSERS[parser].PARSER_VERSION if parser in putil.PARSERS else None
+    return make_key(file_hash(path), parser, version, task.pflags)
+
+
+def _parse(collection, course, name, pflags, use_cache, manifest):
+    """Runs in a worker process, the parsed records are written to disk rather than sent back."""
+
+    parse_fn = putil.parse_material if collection == 'materials' else putil.parse_forum
+    parse_fn(ArgsWrapper(course=course, name=name, pflags=pflags, use_cache=use_cache, manifest=manifest))
+
+
+class Pipeline:
+    """Download and parse every spec row, then export the dataset and filter it.
+
+    Downloads run on a thread pool, and each row is handed to a process pool for parsing as soon as its download
+    completes, so network I/O of some rows overlaps with parsing of others. Nodes whose inputs and outputs are
+    unchanged since the last run are skipped.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.state = State()
+        self.manifests = {}
+        self.fetched = dlutil.Fetched()
+        self.throttle = HostThrottle()
+        self.failed = []
+        # Parse key -> rows waiting on the pending parse of identical bytes with the same flags
+        self.parsing = {}
+
+    def download(self, task):
+        with self.throttle.limit(host_of(task.uri)):
+            if task.collection == 'materials':
+                dlutil.download_material(ArgsWrapper(course=task.course, name=task.name, uri=task.uri,
+                                                     dlflags=task.dlflags, manifest=self.manifests[task.course],
+                                                     fetched=self.fetched, force=self.args.force))
+            else:
+                dlutil.download_forum(ArgsWrapper(course=task.course, name=task.name, uri=task.uri,
+                                                  dlflags=task.dlflags, force=self.args.force))
+
+    def _download_fresh(self, task):
+        if self.args.no_download:
+            return True
+        max_age = self.args.max_age * 3600
+        return not self.args.force and self.state.is_fresh(f'download/{task.id}', _download_key(task), max_age)
+
+    def _submit_parse(self, task, parsers, pending):
+        path = _downloaded_file(task, self.manifests.get(task.course))
+        if path is None:
+            print(f'Failed: {task.id}: no single downloaded copy to parse')
+            self.failed.append(task.id)
+            return
+        key = _parse_key(task, path)
+        if not self.args.force and self.state.is_fresh(f'parse/{task.id}', key):
+            print(f'Up-to-date: {task.id}')
+            return
+        if key in self.parsing:
+            # The same material is linked from another row, wait to reuse its cached parse
+            self.parsing[key].append(task)
+            return
+        self.parsing[key] = []
+        future = parsers.submit(_parse, task.collection, task.course, task.name, task.pflags, not self.args.force,
+                                self._manifest_entries(task))
+        pending[future] = ('parse', task, key)
+
+    def _manifest_entries(self, task):
+        """The manifest entry of a material, for a worker to find its copy without reading the manifest."""
+
+        if task.collection != 'materials':
+            return None
+        return {task.name: self.manifests[task.course].get(task.name)}
+
+    def _submit_waiting(self, key, parsers, pending):
+        for task in self.parsing.pop(key, []):
+            # Forced parses skip the cache, except for bytes already parsed in this run
+            future = parsers.submit(_parse, task.collection, task.course, task.name, task.pflags, True,
+                                    self._manifest_entries(task))
+            pending[future] = ('parse', task, key)
+
+    def run_rows(self, tasks):
+        """Download and parse all rows, returns the number of failed rows."""
+
+        session.configure(pool_size=max(self.args.jobs, session.DEFAULT_POOL_SIZE))
+        downloaders = ThreadPoolExecutor(max_workers=self.args.jobs)
+        parsers = ProcessPoolExecutor(max_workers=self.args.parse_jobs)
+        pending = {}
+        # Shared by the downloads of a course, created upfront as the downloading threads only update them
+        self.manifests = {task.course: Manifest(task.course) for task in tasks if task.collection == 'materials'}
+        try:
+            for task in tasks:
+                if self._download_fresh(task):
+                    self._submit_parse(task, parsers, pending)
+                else:
+                    pending[downloaders.submit(self.download, task)] = ('download', task, _download_key(task))
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, task, key = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'Failed: {stage} {task.id}')
+                        print(f'>', e)
+                        self.failed.append(task.id)
+                        if stage == 'parse':
+                            self._submit_waiting(key, parsers, pending)
+                        continue
+
+                    if stage == 'download':
+                        print(f'Downloaded: {task.id}')
+                        if task.course in self.manifests:
+                            # Parsers resolve materials through the saved manifest
+                            self.manifests[task.course].save()
+                        path = _downloaded_file(task, self.manifests.get(task.course))
+                        self.state.record(f'download/{task.id}', key, [path] if path else [])
+                        self._submit_parse(task, parsers, pending)
+                    else:
+                        print(f'Parsed: {task.id}')
+                        self.state.record(f'parse/{task.id}', key, [_parsed_file(task)])
+                        self._submit_waiting(key, parsers, pending)
+        finally:
+            downloaders.shutdown(cancel_futures=True)
+            parsers.shutdown(cancel_futures=True)
+            for manifest in self.manifests.values():
+                manifest.save()
+            self.state.save()
+            putil.parse_cache.prune()
+
+        return len(self.failed)
+
+    def export(self, tasks):
+        """Export the dataset with xutil, unless none of the parsed files changed.
+
+        Returns the dataset path, and the fingerprint of its inputs.
+        """
+
+        args = self.args
+        output = args.output or os.path.join(DATA_DIR, xutil.WRITERS[args.format][1])
+
+        courses = {}
+        for task in tasks:
+            courses.setdefault(task.course, {'forums': [], 'materials': []})[task.collection].append(task.name)
+        course_keys = [xutil.course_key(pd.Series(files, name=course)) for course, files in sorted(courses.items())]
+        key = make_key(course_keys, args.format, args.shard_rows, args.dedup_threshold)
+
+        if not args.force and os.path.exists(output) and self.state.is_fresh('export', key):
+            print(f'Up-to-date: {output}')
+            return output, key
+
+        xutil.export_dataset(ArgsWrapper(spec_dir=args.spec_dir, course=args.course, format=args.format,
+                                         output=output, shard_rows=args.shard_rows, use_cache=not args.force,
+                                         dedup_threshold=args.dedup_threshold, dedup_report=None))
+        # Directories are fingerprinted through their manifest
+        self.state.record('export', key, [os.path.join(output, 'manifest.json') if os.path.isdir(output) else output])
+        self.state.save()
+        return output, key
+
+    def filter(self, dataset, dataset_key):
+        # Imported here, so that the other stages do not need the word vectors or their dependencies
+        import answerability_filter as af
+
+        args = self.args
+        output = os.path.join(DATA_DIR, 'parrot-qa-filtered.json')
+        key = make_key(dataset_key, af.MODEL_ID, af.ANSWERABILITY_THRESHOLD, args.index, args.n_probe,
+                       args.top_k)
+
+        if not args.force and self.state.is_fresh('filter', key):
+            print(f'Up-to-date: {output}')
+            return
+
+        af.filter_dataset(ArgsWrapper(input=dataset, output=output, prune=args.prune, index=args.index,
+                                      n_lists=None, n_probe=args.n_probe, top_k=args.top_k,
+                                      batch_size=af.DEFAULT_BATCH_SIZE))
+        print(f'Filtered dataset in: {output}')
+        self.state.record('filter', key, [output])
+        self.state.save()
+
+
+def validate_courses(tasks, failed):
+    """Validate the merged records of every course and collection, e.g. for duplicate titles across materials.
+
+    Like `putil.py bulk`, issues are reported as warnings and do not stop the export. Returns how many of the
+    (course, collection) have issues.
+    """
+
+    groups = {}
+    for task in tasks:
+        if task.id not in failed and os.path.isfile(_parsed_file(task)):
+            groups.setdefault((task.course, task.collection), []).append(_parsed_file(task))
+
+    invalid = 0
+    for (course, collection), paths in sorted(groups.items()):
+        records = []
+        for path in paths:
+            with open(path) as fp:
+                records.extend(json.load(fp))
+        validate_fn = putil.validate_doc_list if collection == 'materials' else putil.validate_qa_list
+        try:
+            validate_fn(records)
+        except Exception as e:
+            print(f'WARNING: Parsed {collection} of {course} have issues!')
+            print(f'>', e)
+            invalid += 1
+    return invalid
+
+
+def run_pipeline(args):
+    tasks = load_tasks(args.spec_dir, args.course)
+    pipeline = Pipeline(args)
+
+    failed = pipeline.run_rows(tasks)
+    print(f'\nCompleted {len(tasks) - failed}/{len(tasks)} rows successfully.')
+    validate_courses(tasks, set(pipeline.failed))
+    if failed and not args.keep_going:
+        print('Not exporting, some rows failed. Fix them or use --keep-going to export the rest.')
+        return
+
+    dataset, dataset_key = pipeline.export(tasks)
+    if not args.no_filter:
+        pipeline.filter(dataset, dataset_key)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('spec_dir', help='folder containing specification files named <course>.<collection>.csv')
+    parser.add_argument('--course', default=r'.*', help='regex to filter by course name')
+    parser.add_argument('--jobs', type=int, default=dlutil.DEFAULT_JOBS, help='number of downloads to run concurrently')
+    parser.add_argument('--parse-jobs', type=int, default=DEFAULT_PARSE_JOBS, help='number of worker processes to parse with')
+    parser.add_argument('--max-age', type=float, default=DEFAULT_MAX_AGE,
+                        help='hours during which a download is not revalidated with the server, 0 to always revalidate')
+    parser.add_argument('--no-download', action='store_true', help='only parse the local copies')
+    parser.add_argument('--force', action='store_true', help='rerun every node, ignoring fingerprints and caches')
+    parser.add_argument('--keep-going', action='store_true', help='export even if some rows failed')
+    parser.add_argument('--format', choices=list(xutil.WRITERS), default='json', help='dataset format, see xutil')
+    parser.add_argument('--output', help='path of the dataset, see xutil')
+    parser.add_argument('--shard-rows', type=int, default=xutil.DEFAULT_SHARD_ROWS, help='jsonl: maximum rows per shard')
+    parser.add_argument('--dedup-threshold', type=float, help='drop near-duplicates at this Jaccard similarity, see xutil')
+    parser.add_argument('--no-filter', action='store_true', help='skip the answerability filter')
+    parser.add_argument('--prune', action='store_true', help='filter: use word vectors pruned to the dataset vocabulary')
+    parser.add_argument('--index', choices=sorted(INDEX_BACKENDS), default='exact', help='filter: nearest-neighbour search')
+    parser.add_argument('--n-probe', type=int, default=8, help='filter: ivf clusters searched per question')
+    parser.add_argument('--top-k', type=int, default=0, help='filter: store the k most similar sentences per QA pair')
+    parser.set_defaults(func=run_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -2,14 +2,21 @@ import os
 import json
 import glob
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 
 from common import DATA_DIR, MIN_DOCUMENT_TOKEN_COUNT
-from common import setup_dir, read_spec, validate_spec, ArgsWrapper
+from common import setup_dir, read_spec, validate_spec, file_hash, material_files, put_blob, ArgsWrapper, Manifest
+from cache import JsonCache, make_key
 from parsers import html, pdf, piazza
 
 
+PARSERS = {'html': html, 'pdf': pdf, 'piazza': piazza}
+
+parse_cache = JsonCache('parse')
+
+
 def validate_qa(pair):
     stu_ans = pair.get('student_answer')
     ins_ans = pair.get('instructor_answer')
@@ -52,16 +59,38 @@ def validate_doc_list(docs):
         raise RuntimeError('Duplicate titles in documents.')
 
 
+def run_parser(name, path, pflags, use_cache=True):
+    """Run a parser on a file, reusing the cached output if the file, parser and flags are unchanged.
+
+    PDF documents are titled after the file name, which the key does not cover: they are cached with a placeholder
+    title, and titled after this file on the way out.
+    """
+
+    parser = PARSERS[name]
+    key = make_key(file_hash(path), name, parser.PARSER_VERSION, pflags)
+    records = parse_cache.get(name, key) if use_cache else None
+    if records is None:
+        if name == 'piazza':
+            records = parser.extract_qa(path, **pflags)
+        elif name == 'pdf':
+            records = parser.extract_text(path, **pflags, title=pdf.TITLE_PLACEHOLDER)
+        else:
+            records = parser.extract_text(path, **pflags)
+        parse_cache.put(name, key, records)
+
+    if name == 'pdf':
+        records = pdf.retitle(records, pdf.get_title(path))
+    return records
+
+
 def parse_material(args):
     outdir = setup_dir('documents', args.course)
 
-    infiles = glob.glob(os.path.join(DATA_DIR, 'materials', args.course, f'{glob.escape(args.name)}.*'))
+    infiles = material_files(args.course, args.name, getattr(args, 'manifest', None))
     if len(infiles) == 1:
         extn = infiles[0].split('.')[-1]
-        if extn == 'pdf':
-            spans = pdf.extract_text(infiles[0], **getattr(args, 'pflags', {}))
-        elif extn == 'html':
-            spans = html.extract_text(infiles[0], **getattr(args, 'pflags', {}))
+        if extn in {'pdf', 'html'}:
+            spans = run_parser(extn, infiles[0], getattr(args, 'pflags', {}), getattr(args, 'use_cache', True))
         else:
             raise ValueError(f'No parser available for material type "{extn}".')
     elif len(infiles) == 0:
@@ -90,8 +119,8 @@ def parse_forum(args):
     infiles = glob.glob(os.path.join(DATA_DIR, 'forums', args.course, f'{glob.escape(args.name)}.*'))
     if len(infiles) == 1:
         extn = infiles[0].split('.')[-1]
-        if extn == 'json':
-            pairs = piazza.extract_qa(infiles[0], **getattr(args, 'pflags', {}))
+        if extn in {'json', 'jsonl'}:
+            pairs = run_parser('piazza', infiles[0], getattr(args, 'pflags', {}), getattr(args, 'use_cache', True))
         else:
             raise ValueError(f'No parser available for forum type "{extn}".')
     elif len(infiles) == 0:
@@ -108,6 +137,15 @@ def parse_forum(args):
     return pairs
 
 
+def _parse_row(parse_fn, course, row, use_cache, manifest):
+    if 'pflags' in row and not pd.isnull(row['pflags']):
+        pflags = json.loads(row['pflags'])
+    else:
+        pflags = {}
+    return parse_fn(ArgsWrapper(course=course, name=row['name'], pflags=pflags, use_cache=use_cache,
+                                manifest=manifest))
+
+
 def parse_bulk(args):
     course, collection, df = read_spec(args.spec_file)
     if collection == 'materials':
@@ -122,24 +160,37 @@ def parse_bulk(args):
     if validate_spec(df) == False:
         return
 
+    jobs = getattr(args, 'jobs', 1)
+    use_cache = getattr(args, 'use_cache', True)
+    rows = [row for _, row in df.iterrows()]
+    # Read once for all rows, rather than by every parse
+    manifest = Manifest(course).entries if collection == 'materials' else None
+
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    if pool is not None:
+        futures = [pool.submit(_parse_row, parse_fn, course, row, use_cache, manifest) for row in rows]
+
+    # Collect in spec order, so that records are merged deterministically
     suc = 0
     records = []
-    for _, row in df.iterrows():
-        try:
-            if 'pflags' in row and not pd.isnull(row['pflags']):
-                pflags = json.loads(row['pflags'])
-            else:
-                pflags = {}
-            records.extend(
-                parse_fn(ArgsWrapper(course=course, name=row['name'], pflags=pflags))
-            )
-            print(f'Completed: {row["name"]}')
-            suc += 1
-        except Exception as e:
-            print(f'Failed: {row["name"]}')
-            print(f'>', e)
+    try:
+        for i, row in enumerate(rows):
+            try:
+                if pool is not None:
+                    records.extend(futures[i].result())
+                else:
+                    records.extend(_parse_row(parse_fn, course, row, use_cache, manifest))
+                print(f'Completed: {row["name"]}')
+                suc += 1
+            except Exception as e:
+                print(f'Failed: {row["name"]}')
+                print(f'>', e)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
 
     print(f'\nCompleted {suc}/{len(df)} successfully. Records generated: {len(records)}')
+    parse_cache.prune()
     try:
         validate_fn(records)
     except Exception as e:
@@ -147,6 +198,107 @@ def parse_bulk(args):
         print(f'>', e)
 
 
+def manage_cache(args):
+    if args.action == 'invalidate':
+        parse_cache.invalidate(args.parser)
+        print(f'Invalidated cached parses: {args.parser or "all parsers"}')
+    elif args.action == 'prune':
+        evicted = parse_cache.prune(args.max_entries)
+        print(f'Evicted {evicted} cached parses.')
+
+
+def _pdf_bytes(*pages):
+    """A minimal PDF showing each text of `pages` on a page of its own."""
+
+    kids = ' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages)))
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', f'<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>',
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    for i, text in enumerate(pages):
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {5 + 2 * i} 0 R '
+                       '/Resources << /Font << /F1 3 0 R >> >> >>')
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+    data, offsets = '%PDF-1.4\n', []
+    for i, obj in enumerate(objects):
+        offsets.append(len(data))
+        data += f'{i + 1} 0 obj\n{obj}\nendobj\n'
+    xref = len(data)
+    data += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'
+    data += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets)
+    data += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'
+    return data.encode('latin-1')
+
+
+def run_tests(args):
+    """Unit tests of parsing materials, in a temporary data folder."""
+
+    import shutil
+    import tempfile
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        folder = setup_dir('materials', 'X')
+        data = _pdf_bytes('The same slides were uploaded twice under two different names')
+        for name in ['Syllabus', 'Lecture 1']:
+            with open(os.path.join(folder, f'{name}.pdf'), 'wb') as fp:
+                fp.write(data)
+
+        # Unit test: Identical PDFs under different names share a cached parse, but are titled after their own name
+        for pflags in [{}, {'split': 'page'}]:
+            syllabus = parse_material(ArgsWrapper(course='X', name='Syllabus', pflags=pflags))
+            lecture = parse_material(ArgsWrapper(course='X', name='Lecture 1', pflags=pflags))
+            assert [doc['title'].split(':')[0] for doc in syllabus + lecture] == ['Syllabus', 'Lecture 1']
+            assert syllabus[0]['contents'] == lecture[0]['contents']
+            validate_doc_list(syllabus + lecture)
+        assert len(glob.glob(os.path.join(parse_cache.root, 'pdf', '*.json'))) == 2
+        assert not os.path.exists(os.path.join(DATA_DIR, 'manifests'))
+
+        # Unit test: A material known to the manifest is relinked from its blob, rather than found by name
+        manifest = {'Moved': {'extn': '.pdf', 'sha256': put_blob(data, '.pdf')},
+                    'Gone': {'extn': '.pdf', 'sha256': '0' * 64}}
+        for name in ['Moved', 'Gone']:
+            with open(os.path.join(folder, f'{name}.html'), 'w') as fp:
+                fp.write('<html>Stale copy</html>')
+        assert material_files('X', 'Moved', manifest) == [os.path.join(folder, 'Moved.pdf')]
+        assert material_files('X', 'Gone', manifest) == []
+
+        # Unit test: Misspelled pflags are rejected rather than ignored
+        for pflags in [{'page': [1, 1]}, {'split': 'page', 'job': 2}]:
+            try:
+                parse_material(ArgsWrapper(course='X', name='Syllabus', pflags=pflags, use_cache=False))
+                assert False, pflags
+            except ValueError as e:
+                assert 'Unknown pflags' in str(e)
+
+        # Unit test: Workers lay out pages in order, and only a few chunks ahead of the page being yielded
+        path = os.path.join(folder, 'Long.pdf')
+        with open(path, 'wb') as fp:
+            fp.write(_pdf_bytes(*(f'Page {i}' for i in range(1, 81))))
+        submitted = []
+
+        class CountingExecutor(pdf.ProcessPoolExecutor):
+            def submit(self, *args):
+                submitted.append(args[2])
+                return super().submit(*args)
+
+        executor, pdf.ProcessPoolExecutor = pdf.ProcessPoolExecutor, CountingExecutor
+        try:
+            pages = pdf.iter_pages(path, jobs=2)
+            assert next(pages) == (1, ['Page 1'])
+            assert len(submitted) == 2 * pdf.CHUNKS_AHEAD_PER_JOB + 1
+            assert list(pages) == [(i, [f'Page {i}']) for i in range(2, 81)]
+            assert len(submitted) == 80 // pdf.PAGES_PER_CHUNK
+        finally:
+            pdf.ProcessPoolExecutor = executor
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+    print('All unit tests passed.')
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -156,16 +308,29 @@ if __name__ == '__main__':
     m_parser = subparsers.add_parser('material')
     m_parser.add_argument('course', help='course to which the material belongs')
     m_parser.add_argument('name', help='name of the document to parse')
+    m_parser.add_argument('--no-cache', dest='use_cache', action='store_false', help='ignore cached parses')
     m_parser.set_defaults(func=parse_material)
 
     f_parser = subparsers.add_parser('forum')
     f_parser.add_argument('course', help='course to which the forum belongs')
     f_parser.add_argument('name', help='name of the document to parse')
+    f_parser.add_argument('--no-cache', dest='use_cache', action='store_false', help='ignore cached parses')
     f_parser.set_defaults(func=parse_forum)
 
     b_parser = subparsers.add_parser('bulk')
     b_parser.add_argument('spec_file', help='file named <course>.<collection>.csv, containing name, links, etc.')
+    b_parser.add_argument('--no-cache', dest='use_cache', action='store_false', help='ignore cached parses')
+    b_parser.add_argument('--jobs', type=int, default=1, help='number of worker processes to parse with')
     b_parser.set_defaults(func=parse_bulk)
 
+    c_parser = subparsers.add_parser('cache')
+    c_parser.add_argument('action', choices=['invalidate', 'prune'], help='drop cached parses, or evict least recently used ones')
+    c_parser.add_argument('--parser', choices=list(PARSERS), help='only invalidate parses of this parser')
+    c_parser.add_argument('--max-entries', type=int, default=None, help='number of cached parses to keep when pruning')
+    c_parser.set_defaults(func=manage_cache)
+
+    t_parser = subparsers.add_parser('test')
+    t_parser.set_defaults(func=run_tests)
+
     args = parser.parse_args()
     args.func(args)
@@ -1,11 +1,43 @@
 import os
 import json
 import glob
+import gzip
 import re
+import shutil
 
 import pandas as pd
 
-from common import DATA_DIR, read_spec, validate_spec
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from cache import JsonCache, make_key
+from common import DATA_DIR, read_spec, validate_spec, file_hash, write_atomic
+from dedup import NearDuplicates
+
+
+TABLES = ['qa_pairs', 'documents']
+
+DEFAULT_SHARD_ROWS = 50000
+
+# Bump whenever the layout of sharded datasets changes
+MANIFEST_VERSION = 1
+
+PARQUET_COMPRESSION = 'zstd'
+
+# Bump whenever a change affects the collated output, this invalidates cached courses
+COLLATE_VERSION = 1
+
+collate_cache = JsonCache('collate')
+
+# Identifier and text compared for near-duplicates, per table
+DEDUP_FIELDS = {'qa_pairs': ('q_id', 'title'), 'documents': ('article_title', 'passage_text')}
+
+# Characters of a dropped text kept in the dedup report
+REPORT_TEXT_LENGTH = 200
 
 
 def collate_document(doc, skip=['code']):
@@ -36,12 +68,36 @@ def collate_answers(pair):
     return records
 
 
-def collate_course(meta):
+def _input_files(meta):
     course = meta.name
+    return ([os.path.join(DATA_DIR, 'qa_pairs', course, f'{fname}.json') for fname in meta['forums']],
+            [os.path.join(DATA_DIR, 'documents', course, f'{mname}.json') for mname in meta['materials']])
+
+
+def course_key(meta):
+    """Cache key of a collated course: the hashes of all of its parsed files, in spec order."""
+
+    forum_files, material_files = _input_files(meta)
+    hashes = [file_hash(f) if os.path.isfile(f) else None for f in forum_files + material_files]
+    return make_key(COLLATE_VERSION, meta.name, forum_files, material_files, hashes)
+
+
+def collate_course(meta, use_cache=True):
+    """Collate a course, or reuse its cached collation if none of its parsed files changed.
+
+    Returns the QA pairs, the documents, and whether the course was recollated.
+    """
+
+    course = meta.name
+    key = course_key(meta)
+    if use_cache and (cached := collate_cache.get(course, key)) is not None:
+        return cached['qa_pairs'], cached['documents'], False
+
+    complete = True
+    forum_files, material_files = _input_files(meta)
 
     qa_pairs = []
-    for fname in meta['forums']:
-        ffile = os.path.join(DATA_DIR, 'qa_pairs', course, f'{fname}.json')
+    for fname, ffile in zip(meta['forums'], forum_files):
         try:
             with open(ffile) as fp:
                 for pair in json.load(fp):
@@ -56,10 +112,10 @@ def collate_course(meta):
         except Exception as e:
             print(f'Aborting forum midway due to error: {course} {fname}')
             print(' >', e)
+            complete = False
 
     documents = []
-    for mname in meta['materials']:
-        mfile = os.path.join(DATA_DIR, 'documents', course, f'{mname}.json')
+    for mname, mfile in zip(meta['materials'], material_files):
         try:
             with open(mfile) as fp:
                 for doc in json.load(fp):
@@ -74,25 +130,285 @@ def collate_course(meta):
         except Exception as e:
             print(f'Aborting document midway due to error: {course} {mname}')
             print(' >', e)
+            complete = False
 
-    return qa_pairs, documents
+    # Courses with errors are not cached, so that their errors are reported again on the next export
+    if complete:
+        collate_cache.invalidate(course)
+        collate_cache.put(course, key, {'qa_pairs': qa_pairs, 'documents': documents})
+    return qa_pairs, documents, True
 
 
-def display_stats(qa_pairs, documents):
-    qa_df = pd.DataFrame(qa_pairs)
-    doc_df = pd.DataFrame(documents)
+def drop_near_duplicates(table, rows, seen, dropped):
+    """Rows that are not near-duplicates of a row kept before, from this or an earlier course.
 
-    qa_stat = qa_df.groupby('course').agg({'title': 'count', 'is_answerable': 'sum'})
-    qa_stat.columns = ['count', 'answerable']
+    `seen` is the table's `NearDuplicates` filter, shared by all courses. Dropped rows are appended to `dropped`.
+    """
+
+    id_field, text_field = DEDUP_FIELDS[table]
+    kept = []
+    for row in rows:
+        key = {'course': row['course'], id_field: row[id_field]}
+        match = seen.check(key, row[text_field])
+        if match is None:
+            kept.append(row)
+        else:
+            dropped.append({
+                'table': table,
+                **key,
+                'text': row[text_field][:REPORT_TEXT_LENGTH],
+                'duplicate_of': match[0],
+                'similarity': match[1]
+            })
+    return kept
 
-    doc_stat = doc_df.groupby('course').agg({'passage_text': 'count'})
-    doc_stat.columns = ['count']
 
-    stat = qa_stat.join(doc_stat, lsuffix='_qa', rsuffix='_doc', how='outer')
+def course_stats(qa_pairs, documents):
+    """Counts of a single course, accumulated across courses for `display_stats`."""
+
+    return {
+        'count_qa': len(qa_pairs),
+        'answerable': sum(1 for pair in qa_pairs if pair['is_answerable']),
+        'count_doc': len(documents)
+    }
+
+
+def display_stats(stats):
+    stat = pd.DataFrame.from_dict(stats, orient='index', columns=['count_qa', 'answerable', 'count_doc'])
+    stat.index.name = 'course'
     stat = stat.fillna(0).astype(int)
     print('\n', stat)
 
 
+class JsonWriter:
+    """Single pretty-printed JSON file, holding every course in memory until closed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.qa_pairs = []
+        self.documents = []
+
+    def write_course(self, course, qa_pairs, documents):
+        self.qa_pairs.extend(qa_pairs)
+        self.documents.extend(documents)
+
+    def close(self):
+        with open(self.path, 'w') as fp:
+            json.dump({
+                'qa_pairs': self.qa_pairs,
+                'documents': self.documents
+            }, fp, indent=4)
+
+
+class _ShardedTable:
+    """Rows of a table written to <name>-<n>.jsonl.gz files of at most `shard_rows` rows each."""
+
+    def __init__(self, root, name, shard_rows):
+        self.root = root
+        self.name = name
+        self.shard_rows = shard_rows
+        self.shards = []
+        self.fp = None
+
+    def write(self, course, rows):
+        for row in rows:
+            if self.fp is None or self.shards[-1]['rows'] >= self.shard_rows:
+                self._next_shard()
+            self.fp.write(json.dumps(row) + '\n')
+            shard = self.shards[-1]
+            shard['rows'] += 1
+            if course not in shard['courses']:
+                shard['courses'].append(course)
+
+    def _next_shard(self):
+        if self.fp is not None:
+            self.fp.close()
+        file = f'{self.name}-{len(self.shards):05d}.jsonl.gz'
+        self.fp = gzip.open(os.path.join(self.root, file), 'wt', encoding='utf-8')
+        self.shards.append({'file': file, 'rows': 0, 'courses': []})
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+        return {'rows': sum(shard['rows'] for shard in self.shards), 'shards': self.shards}
+
+
+class _DatasetDir:
+    """Dataset directory with a manifest.json, built in a temporary directory and replacing the previous one
+    only once complete."""
+
+    format = None
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f'{path}.tmp'
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.courses = {}
+
+    def _finish(self, tables):
+        manifest = {
+            'format': self.format,
+            'version': MANIFEST_VERSION,
+            'tables': tables,
+            'courses': self.courses
+        }
+        with open(os.path.join(self.tmp_path, 'manifest.json'), 'w') as fp:
+            json.dump(manifest, fp, indent=4)
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+
+class JsonlShardWriter(_DatasetDir):
+    """Directory of gzipped JSON Lines shards per table, plus a manifest.json describing shards and courses.
+
+    Courses are written as they come, so only one course is held in memory.
+    """
+
+    format = 'jsonl'
+
+    def __init__(self, path, shard_rows=DEFAULT_SHARD_ROWS):
+        super().__init__(path)
+        self.tables = {name: _ShardedTable(self.tmp_path, name, shard_rows) for name in TABLES}
+
+    def write_course(self, course, qa_pairs, documents):
+        self.tables['qa_pairs'].write(course, qa_pairs)
+        self.tables['documents'].write(course, documents)
+        self.courses[course] = course_stats(qa_pairs, documents)
+
+    def close(self):
+        self._finish({name: table.close() for name, table in self.tables.items()})
+
+
+def _schemas():
+    answers = pa.struct([
+        ('a_id', pa.list_(pa.string())),
+        ('text', pa.list_(pa.string())),
+        ('score', pa.list_(pa.int64()))
+    ])
+    return {
+        'qa_pairs': pa.schema([
+            ('q_id', pa.string()),
+            ('title', pa.string()),
+            ('answers', answers),
+            ('course', pa.string()),
+            ('tags', pa.list_(pa.string())),
+            ('is_answerable', pa.bool_())
+        ]),
+        'documents': pa.schema([
+            ('course', pa.string()),
+            ('article_title', pa.string()),
+            ('section_title', pa.string()),
+            ('passage_text', pa.string()),
+            ('source_type', pa.string())
+        ])
+    }
+
+
+class ParquetWriter(_DatasetDir):
+    """Directory of Parquet tables, partitioned by course: <table>/course=<course>/part-0.parquet.
+
+    The partition column is not stored in the files, readers get it back from the path (hive partitioning).
+    """
+
+    format = 'parquet'
+
+    def __init__(self, path, compression=PARQUET_COMPRESSION):
+        if pa is None:
+            raise RuntimeError('Parquet output requires pyarrow, install it with: pip install pyarrow')
+        super().__init__(path)
+        self.compression = compression
+        self.schemas = _schemas()
+        self.tables = {name: {'rows': 0, 'files': []} for name in TABLES}
+
+    def write_course(self, course, qa_pairs, documents):
+        for name, rows in [('qa_pairs', qa_pairs), ('documents', documents)]:
+            file = os.path.join(name, f'course={course}', 'part-0.parquet')
+            os.makedirs(os.path.dirname(os.path.join(self.tmp_path, file)))
+            table = pa.Table.from_pylist(rows, schema=self.schemas[name])
+            table = table.remove_column(table.schema.get_field_index('course'))
+            pq.write_table(table, os.path.join(self.tmp_path, file), compression=self.compression)
+            self.tables[name]['rows'] += len(rows)
+            self.tables[name]['files'].append(file)
+        self.courses[course] = course_stats(qa_pairs, documents)
+
+    def close(self):
+        self._finish(self.tables)
+
+
+WRITERS = {
+    'json': (JsonWriter, 'parrot-qa.json'),
+    'jsonl': (JsonlShardWriter, 'parrot-qa'),
+    'parquet': (ParquetWriter, 'parrot-qa.parquet')
+}
+
+
+def parquet_table(path, table):
+    """A table of a Parquet dataset as a pyarrow Dataset, which can be filtered and projected lazily."""
+
+    if pa is None:
+        raise RuntimeError('Reading Parquet datasets requires pyarrow, install it with: pip install pyarrow')
+    schema = _schemas()[table]
+    return ds.dataset(os.path.join(path, table), format='parquet', schema=schema,
+                      partitioning=ds.partitioning(pa.schema([schema.field('course')]), flavor='hive'))
+
+
+def parquet_stats(path):
+    """Per-course stats of a Parquet dataset, only reading the is_answerable column and file metadata."""
+
+    qa = parquet_table(path, 'qa_pairs').to_table(columns=['course', 'is_answerable']).to_pandas()
+    docs = parquet_table(path, 'documents').to_table(columns=['course']).to_pandas()
+
+    stats = {}
+    for course, group in qa.groupby('course'):
+        stats.setdefault(course, {})
+        stats[course]['count_qa'] = len(group)
+        stats[course]['answerable'] = int(group['is_answerable'].sum())
+    for course, group in docs.groupby('course'):
+        stats.setdefault(course, {})
+        stats[course]['count_doc'] = len(group)
+    return stats
+
+
+def read_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as fp:
+        return json.load(fp)
+
+
+def iter_rows(path, table, courses=None):
+    """Stream the rows of a table ('qa_pairs' or 'documents') of a sharded or Parquet dataset, optionally only of
+    some courses. Shards and partitions without any of these courses are not read."""
+
+    manifest = read_manifest(path)
+    if manifest['format'] == 'parquet':
+        dataset = parquet_table(path, table)
+        row_filter = ds.field('course').isin(list(courses)) if courses is not None else None
+        for batch in dataset.to_batches(filter=row_filter):
+            yield from batch.to_pylist()
+        return
+
+    for shard in manifest['tables'][table]['shards']:
+        if courses is not None and not set(shard['courses']) & set(courses):
+            continue
+        with gzip.open(os.path.join(path, shard['file']), 'rt', encoding='utf-8') as fp:
+            for line in fp:
+                row = json.loads(line)
+                if courses is None or row['course'] in courses:
+                    yield row
+
+
+def load_dataset(path):
+    """Load an exported dataset, either a JSON file or a sharded or Parquet directory, as
+    {'qa_pairs': [], 'documents': []}."""
+
+    if os.path.isdir(path):
+        return {table: list(iter_rows(path, table)) for table in TABLES}
+    with open(path) as fp:
+        return json.load(fp)
+
+
 def export_dataset(args):
     spec_files = glob.glob(os.path.join(args.spec_dir, '*.*.csv'), recursive=False)
     meta_df = []
@@ -111,21 +427,40 @@ def export_dataset(args):
         print(meta_df)
         return
 
-    qa_pairs = []
-    documents = []
-    for _, row in meta_df.iterrows():
-        qa, docs = collate_course(row)
-        qa_pairs.extend(qa)
-        documents.extend(docs)
+    writer_class, default_output = WRITERS[args.format]
+    db_file = args.output or os.path.join(DATA_DIR, default_output)
+    writer_args = {'shard_rows': args.shard_rows} if args.format == 'jsonl' else {}
+    writer = writer_class(db_file, **writer_args)
+
+    # Near-duplicates are dropped in course order, keeping the first occurrence
+    seen = None
+    if args.dedup_threshold is not None:
+        seen = {table: NearDuplicates(args.dedup_threshold) for table in TABLES}
+        dropped = []
+
+    stats = {}
+    recollated = []
+    for course, row in meta_df.iterrows():
+        qa, docs, changed = collate_course(row, args.use_cache)
+        if seen is not None:
+            qa = drop_near_duplicates('qa_pairs', qa, seen['qa_pairs'], dropped)
+            docs = drop_near_duplicates('documents', docs, seen['documents'], dropped)
+        writer.write_course(course, qa, docs)
+        stats[course] = course_stats(qa, docs)
+        if changed:
+            recollated.append(course)
 
-    db_file = os.path.join(DATA_DIR, 'parrot-qa.json')
-    with open(db_file, 'w') as fp:
-        json.dump({
-            'qa_pairs': qa_pairs,
-            'documents': documents
-        }, fp, indent=4)
-        print(f'\nGenerated dataset in: {db_file}')
-        display_stats(qa_pairs, documents)
+    writer.close()
+    print(f'Recollated {len(recollated)} of {len(stats)} courses: {", ".join(recollated) or "none"}')
+    if seen is not None:
+        report = args.dedup_report or os.path.join(DATA_DIR, 'dedup-report.json')
+        data = json.dumps({'threshold': args.dedup_threshold, 'dropped': dropped}, indent=4)
+        write_atomic(report, data.encode('utf-8'))
+        counts = {table: sum(1 for d in dropped if d['table'] == table) for table in TABLES}
+        print(f'Dropped {counts["qa_pairs"]} QA pairs and {counts["documents"]} documents as near-duplicates, '
+              f'see: {report}')
+    print(f'\nGenerated dataset in: {db_file}')
+    display_stats(parquet_stats(db_file) if args.format == 'parquet' else stats)
 
 
 if __name__ == '__main__':
@@ -134,6 +469,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('spec_dir', help='folder containing specification files named <course>.<collection>.csv')
     parser.add_argument('--course', help='regex to filter by course name', default=r'.*')
+    parser.add_argument('--format', choices=list(WRITERS), default='json',
+                        help='single JSON file, directory of compressed JSON Lines shards, or Parquet tables partitioned by course')
+    parser.add_argument('--output', help='path of the dataset, defaults to parrot-qa.json, parrot-qa/ or parrot-qa.parquet/ in the data folder')
+    parser.add_argument('--shard-rows', type=int, default=DEFAULT_SHARD_ROWS, help='jsonl: maximum rows per shard')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', help='recollate every course')
+    parser.add_argument('--dedup-threshold', type=float,
+                        help='drop QA pairs and documents whose Jaccard similarity to an earlier one is at least this')
+    parser.add_argument('--dedup-report', help='report of the dropped near-duplicates, defaults to dedup-report.json in the data folder')
     parser.set_defaults(func=export_dataset)
 
     args = parser.parse_args()